@@ -1,7 +1,31 @@
 from flask import Flask
 from flask_pymongo import PyMongo
+from . import config
 
 app = Flask(__name__)
-app.secret_key = 'temp_secret_key'
-app.config["MONGO_URI"] = "mongodb://mongo:27017/projectDb"
-mongo = PyMongo(app)
+app.secret_key = config.SECRET_KEY
+app.config["MONGO_URI"] = config.MONGO_URI
+app.config["MAX_CONTENT_LENGTH"] = config.MAX_CONTENT_LENGTH
+app.config["UPLOAD_STAGING"] = "gridfs"  # "gridfs" streams uploads into a staging bucket, "tempdir" keeps them on local disk
+# connect=False defers connecting until first use, so a client created before
+# gunicorn forks its workers never shares sockets with them
+mongo = PyMongo(app, connect=False, **config.MONGO_CLIENT_OPTIONS)
+
+from .utilities.sessions import create_session_interface
+app.session_interface = create_session_interface(config.SESSION_BACKEND)
+
+def init_database(start_background=True):
+    """
+    Create the indexes and finish interrupted migrations and deletions. Run once at start-up.
+    gunicorn runs it through `flask init-db` with start_background=False, in a child process of
+    the master; each worker then starts its own deletion and import resumers and conversion
+    job keeper from post_worker_init.
+    """
+    from .utilities import indexes, file_storage, project_deletion, conversion, bulk_import
+    indexes.ensure_indexes()
+    file_storage.migrate_embedded_versions()
+    conversion.purge_legacy_results()
+    if start_background:
+        project_deletion.start_resumer()
+        conversion.start_job_keeper()
+        bulk_import.start_resumer()
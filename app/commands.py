@@ -0,0 +1,43 @@
+import click
+from . import app, init_database
+from .utilities import bulk_import, search
+
+# Command line tools, run from the app directory, e.g.: flask --app run import-archive reports.zip
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the indexes and finish interrupted migrations. Run once before serving."""
+    # Interrupted deletions and conversions are resumed by the serving processes, not by this one-shot command
+    init_database(start_background=False)
+    click.echo("Database ready")
+
+@app.cli.command('import-archive')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=bulk_import.IMPORT_WORKERS, show_default=True, help='Files imported in parallel.')
+@click.option('--no-convert', is_flag=True, help='Store PDFs without converting them to HTML.')
+def import_archive_command(archive, workers, no_convert):
+    """Create one project per PDF, DOCX and HTML file in a zip or tar ARCHIVE."""
+    def progress(result):
+        click.echo(f"{result['status']:>17}  {result['entry']}")
+
+    try:
+        results = bulk_import.import_archive(archive, convert_pdfs=not no_convert, workers=workers, on_result=progress)
+    except bulk_import.ArchiveError as e:
+        raise click.ClickException(str(e))
+
+    click.echo()
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    click.echo(', '.join(f"{count} {status}" for status, count in sorted(counts.items())))
+    for result in results:
+        if result.get('error'):
+            click.echo(f"{result['entry']}: {result['error']}", err=True)
+    if counts.get('failed') or counts.get('conversion_failed'):
+        raise SystemExit(1)
+
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Add every saved HTML version that is missing from the search index."""
+    click.echo(f"{search.reindex_all()} versions indexed")
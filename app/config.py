@@ -0,0 +1,36 @@
+import os
+
+# Settings read from the environment. The defaults match the docker-compose setup.
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://mongo:27017/projectDb")
+SECRET_KEY = os.environ.get("SECRET_KEY", "temp_secret_key")
+# "mongo" shares sessions between workers and replicas, "local" keeps them in process memory
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "mongo")
+# Where new file contents are written: "gridfs" (in MongoDB) or "local" (files under
+# STORAGE_ROOT, which every replica must share). Metadata always stays in MongoDB.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gridfs")
+STORAGE_ROOT = os.environ.get("STORAGE_ROOT", "/data/blobs")
+
+def _int_env(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+# Largest request body accepted; bigger files go through the resumable /uploads protocol
+# in chunks, and bigger import archives through the import-archive command
+MAX_CONTENT_LENGTH = _int_env("MAX_CONTENT_LENGTH", 100 * 1024 * 1024)
+
+# Passed to MongoClient. Unset options fall back to the pymongo defaults.
+# Each process (gunicorn worker) has its own pool, so the connections opened against
+# MongoDB add up to roughly workers * MONGO_MAX_POOL_SIZE.
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": _int_env("MONGO_MAX_POOL_SIZE", 100),
+    "minPoolSize": _int_env("MONGO_MIN_POOL_SIZE", 0),
+    "maxIdleTimeMS": _int_env("MONGO_MAX_IDLE_TIME_MS"),
+    "waitQueueTimeoutMS": _int_env("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+    "connectTimeoutMS": _int_env("MONGO_CONNECT_TIMEOUT_MS"),
+    "socketTimeoutMS": _int_env("MONGO_SOCKET_TIMEOUT_MS"),
+    "serverSelectionTimeoutMS": _int_env("MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+    # Comma-separated list such as "zstd,zlib"; zstd and snappy need their python packages
+    "compressors": os.environ.get("MONGO_COMPRESSORS"),
+    "zlibCompressionLevel": _int_env("MONGO_ZLIB_COMPRESSION_LEVEL"),
+}
+MONGO_CLIENT_OPTIONS = {key: value for key, value in MONGO_CLIENT_OPTIONS.items() if value is not None}
@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+import multiprocessing
+
+# Production serving profile, used as: gunicorn -c gunicorn.conf.py wsgi:app
+# Every setting can be overridden from the environment.
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5002")
+
+# gthread workers serve several requests per process while a thread waits on MongoDB
+# or pdftohtml; "sync" gives one request per process, "gevent" needs the gevent package.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# Load the app once in the master and fork it, so workers share the imported code
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# /pages converts up to ten PDF pages synchronously, so the worker timeout leaves room for it
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Recycle workers now and then to bound memory growth from large conversions
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG", "-")
+errorlog = os.environ.get("GUNICORN_ERRORLOG", "-")
+
+def when_ready(server):
+    # Prepare the database once, in a short-lived child process with its own MongoClient,
+    # so the master never opens the client its forked workers inherit
+    subprocess.run([sys.executable, "-m", "flask", "--app", "wsgi", "init-db"],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+def post_worker_init(worker):
+    # Threads do not survive the fork, so every worker starts its own resumers of project
+    # deletions and bulk imports and its keeper of conversion jobs, which adopt work left
+    # behind by recycled or killed workers
+    from app.utilities import project_deletion, conversion, bulk_import
+    project_deletion.start_resumer()
+    conversion.start_job_keeper()
+    bulk_import.start_resumer()
@@ -1,11 +1,7 @@
 // initialization of the database
 db = db.getSiblingDB('projectDb');
 
-// Adding indexes for quicker lookups
-db.projects.createIndex({ "project_id": 1 });
-db.documents.createIndex({ "document_id": 1 });
-db.annotations.createIndex({ "annotation_id": 1 });
-db.annotations.createIndex({ "document_id": 1 });
+// Indexes are declared in app/utilities/indexes.py and created when the app starts
 
 // attack flow projects initialization
 db.createCollection("projects");
@@ -1,14 +1,13 @@
 # Standard Libraries
 import os
-import tempfile
-import subprocess
-import re
-import base64
 
 # Flask Libraries
-from flask import render_template, request, redirect, url_for, Response, session, send_from_directory, jsonify
+from flask import render_template, request, redirect, url_for, Response, session, send_from_directory, send_file, jsonify
+from werkzeug.datastructures import ContentRange
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from . import app, mongo
-from .utilities import file_storage
+from .utilities import file_storage, staging, conversion, project_deletion, scratch, bulk_import, search, annotations as annotation_store
 
 # Constants
 CONTENT_TYPES = {
@@ -44,11 +43,97 @@ def upload_file():
         file = request.files.get('file')
         if not file:
             return 'No file part', 400
-        temp_file_path = os.path.join(tempfile.gettempdir(), file.filename)
-        file.save(temp_file_path)
-        session['temp_file_path'] = temp_file_path
+        if app.config.get('UPLOAD_STAGING') == 'gridfs':
+            # Stream the upload into the staging bucket, no local disk involved
+            staging.discard_staged_file(session.get('staged_file_id'))
+            session['staged_file_id'] = str(staging.stage_upload(file.stream, file.filename))
+            session['staged_filename'] = file.filename
+            session.pop('temp_file_path', None)
+        else:
+            try:
+                temp_file_path = scratch.write_scratch_file(session.sid, file.filename, file.stream)
+            except scratch.ScratchQuotaExceeded as e:
+                return str(e), 413
+            session['temp_file_path'] = temp_file_path
     return render_template("upload.html", temp_file_path=temp_file_path)
 
+# Resumable uploads: POST /uploads opens one, PATCH appends at Upload-Offset,
+# POST /uploads/<id>/finalize verifies it and stages it like /upload does
+
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'success': False, 'error': 'filename and size are required'}), 400
+    if size > staging.MAX_UPLOAD_BYTES:
+        return jsonify({'success': False, 'error': 'File too large'}), 413
+
+    upload_id = staging.start_upload(filename, size)
+    return jsonify({
+        'success': True,
+        'upload_id': str(upload_id),
+        'offset': 0,
+        'max_chunk_size': staging.MAX_APPEND_BYTES,
+        'upload_url': url_for('upload_status', upload_id=str(upload_id))
+    }), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = staging.get_upload(upload_id)
+    if not upload:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'offset': upload['offset'], 'size': upload['size']})
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_upload(upload_id):
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'success': False, 'error': 'Upload-Offset header missing'}), 400
+    if (request.content_length or 0) > staging.MAX_APPEND_BYTES:
+        return jsonify({'success': False, 'error': f'Chunks are limited to {staging.MAX_APPEND_BYTES} bytes'}), 413
+
+    try:
+        new_offset = staging.append_upload(upload_id, offset, request.get_data(), request.headers.get('Upload-Checksum'))
+    except staging.OffsetMismatch as e:
+        # The client resumes from the offset the server actually reached
+        return jsonify({'success': False, 'error': str(e), 'offset': e.offset}), 409
+    except staging.ChecksumMismatch as e:
+        return jsonify({'success': False, 'error': str(e), 'offset': offset}), 422
+    if new_offset is None:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'offset': new_offset})
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def discard_upload(upload_id):
+    staging.discard_upload(upload_id)
+    return jsonify({'success': True})
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        staged_id = staging.finalize_upload(upload_id, data.get('sha256'))
+    except staging.OffsetMismatch as e:
+        return jsonify({'success': False, 'error': 'Upload incomplete', 'offset': e.offset}), 409
+    except staging.ChecksumMismatch as e:
+        return jsonify({'success': False, 'error': str(e)}), 422
+    if staged_id is None:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+
+    staged = staging.get_staged_file(staged_id)
+    if staged is None:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+
+    # A retried finalize must not discard the file it staged the first time
+    if session.get('staged_file_id') != str(staged_id):
+        staging.discard_staged_file(session.get('staged_file_id'))
+    session['staged_file_id'] = str(staged_id)
+    session['staged_filename'] = staged.filename
+    session.pop('temp_file_path', None)
+    return jsonify({'success': True, 'staged_file_id': str(staged_id)})
+
 @app.route('/session_file_info')
 def get_session_file_info():
     file_name = session.get('filename')
@@ -56,81 +141,153 @@ def get_session_file_info():
     project_id = session.get('project_id')
     file_type = '.' + (file_name.split('.')[-1] if file_name else 'Empty')
     temp_file_path = session.get('temp_file_path')  
+    staged_file_id = session.get('staged_file_id')
 
     return jsonify({
         'filename': file_name if file_name else 'Empty',
         'filetype': file_type,
         'file_id': file_id if file_id else 'Empty',
         'project_id': project_id if project_id else 'Empty',
-        'temp_file_path': temp_file_path if temp_file_path else 'Empty'
+        'temp_file_path': temp_file_path if temp_file_path else 'Empty',
+        'staged_file_id': staged_file_id if staged_file_id else 'Empty'
     })
 
 
 # ---------- FILE MANAGEMENT ROUTES ----------
-def save_temp_file(file_data):
-    # Save the file to the system's temp directory
-    temp_path = os.path.join(tempfile.gettempdir(), file_data['filename'])
-    with open(temp_path, 'wb') as f:
-        f.write(file_data['file_object'].read())
-    return temp_path
+def accepted_encodings():
+    # Content codings the client accepts, used to pass compressed blobs through untouched
+    return tuple(coding for coding in ('gzip',) if request.accept_encodings[coding])
+
+def send_gridfs_file(file_obj, content_type, content_encoding=None):
+    # Stream a GridFS file chunk by chunk, honouring a single HTTP Range
+    length = file_obj.length
+    headers = {'Accept-Ranges': 'bytes', 'Vary': 'Accept-Encoding'}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+
+    if getattr(file_obj, 'path', None):
+        # Blobs on the local filesystem go out through wsgi.file_wrapper (sendfile under gunicorn)
+        file_obj.close()
+        response = send_file(file_obj.path, mimetype=content_type, conditional=True, etag=False, max_age=None)
+        response.headers.update(headers)
+        return response
+    status = 200
+    start, end = 0, length
+
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        span = byte_range.range_for_length(length)
+        if span is None:
+            headers['Content-Range'] = f'bytes */{length}'
+            return Response(status=416, headers=headers)
+        start, end = span
+        status = 206
+        headers['Content-Range'] = ContentRange('bytes', start, end, length).to_header()
+
+    headers['Content-Length'] = str(end - start)
+    return Response(file_storage.iter_file_chunks(file_obj, start, end), status=status,
+                    headers=headers, content_type=content_type, direct_passthrough=True)
 
 @app.route('/display/<file_id>')
 def display_file(file_id):
-    file_data = file_storage.get_file_by_id(file_id)
-    # Ensure file_data has the expected data
-    if not file_data or 'file_object' not in file_data:
+    # Stored versions never change: answer revalidation from the file document alone
+    encodings = accepted_encodings()
+    etag = file_storage.file_etag(file_id, encodings)
+    if etag is None:
         return jsonify({'error': 'Document not found'}), 404
-
-    # Extract file object and filename from the dictionary
-    file_obj = file_data['file_object']
-    filename = file_data['filename']
-    
-    ext = os.path.splitext(filename)[-1]
-
-    # Checking file type
-    if not is_supported_file_type(filename):
-        print("Unsupported file type", filename)
-        return "Unsupported file type", 400
-    
-    # Respond with the file's content
-    return Response(file_obj.read(), content_type=CONTENT_TYPES[ext])
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers={'Vary': 'Accept-Encoding'})
+    else:
+        file_data = file_storage.get_file_by_id(file_id, encodings)
+        # Ensure file_data has the expected data
+        if not file_data or 'file_object' not in file_data:
+            return jsonify({'error': 'Document not found'}), 404
+
+        # Extract file object and filename from the dictionary
+        file_obj = file_data['file_object']
+        filename = file_data['filename']
+
+        ext = os.path.splitext(filename)[-1]
+
+        # Checking file type
+        if not is_supported_file_type(filename):
+            print("Unsupported file type", filename)
+            return "Unsupported file type", 400
+
+        # Stream the file's content, serving partial ranges to the PDF viewer
+        response = send_gridfs_file(file_obj, CONTENT_TYPES[ext], file_data['content_encoding'])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@app.route('/assets/<asset_id>')
+def serve_asset(asset_id):
+    # Assets are content-addressed, so the URL never changes meaning and can be cached forever
+    if request.if_none_match.contains(asset_id):
+        response = Response(status=304)
+    else:
+        asset = file_storage.open_asset(asset_id)
+        if asset is None:
+            return jsonify({'error': 'Asset not found'}), 404
+        response = send_gridfs_file(asset, (asset.metadata or {}).get('content_type', 'application/octet-stream'))
+    response.set_etag(asset_id)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 @app.route('/clear_temp', methods=['POST'])
 def clear_temp():
-    temp_file_path = session.pop('temp_file_path', None)
+    staged_file_id = session.pop('staged_file_id', None)
     session.clear()
 
-    if temp_file_path and os.path.exists(temp_file_path):
-        os.remove(temp_file_path)
+    scratch.remove_session_dir(session.sid)
+    staging.discard_staged_file(staged_file_id)
     return jsonify({"message": "Temp file cleared."})
 
 @app.route('/save', methods=['POST'])
 def save_file():
     filename = request.form.get('filename')
     temp_file_path = session.get('temp_file_path')
+    staged_file_id = session.get('staged_file_id')
     
-    if not temp_file_path or not os.path.exists(temp_file_path):
+    if staged_file_id:
+        original_name = session.get('staged_filename', '')
+    elif temp_file_path and os.path.exists(temp_file_path):
+        original_name = temp_file_path
+    else:
         return jsonify({
             "status": "error",
             "message": "Error: Temporary file missing"
         })
 
-    original_extension = os.path.splitext(temp_file_path)[-1]
+    original_extension = os.path.splitext(original_name)[-1]
     if not filename.endswith(original_extension):
         filename += original_extension
 
-    existing_file = mongo.db.fs.files.find_one({"filename": filename})
-    if existing_file:
-        return jsonify({
-            "status": "error",
-            "message": "File name already exists, choose another name."
-        })
+    name_taken = jsonify({
+        "status": "error",
+        "message": "File name already exists, choose another name."
+    })
+    if mongo.db.fs.files.find_one({"filename": filename}, {"_id": 1}):
+        return name_taken
 
-    with open(temp_file_path, 'rb') as f:
-        file_id = file_storage.save_file(f, filename)
-    
-    os.remove(temp_file_path)
-    session.pop('temp_file_path', None)
+    # The unique filename index settles concurrent saves under the same name
+    try:
+        if staged_file_id:
+            file_id = staging.promote_staged_file(staged_file_id, filename, unique_name=True)
+            session.pop('staged_file_id', None)
+            session.pop('staged_filename', None)
+            if not file_id:
+                return jsonify({
+                    "status": "error",
+                    "message": "Error: Staged file expired or missing"
+                })
+        else:
+            with open(temp_file_path, 'rb') as f:
+                file_id = file_storage.save_file(f, filename, unique_name=True)
+            os.remove(temp_file_path)
+            session.pop('temp_file_path', None)
+    except DuplicateKeyError:
+        return name_taken
     
     return jsonify({
         "status": "success",
@@ -142,6 +299,30 @@ def create_project_route():
     name = request.form.get('projectname')
     file = request.files.get('initialfile')
     filename = file.filename if file else None
+    staged_file_id = request.form.get('staged_file_id')
+
+    if staged_file_id and not file:
+        # Promote an upload already streamed into the staging bucket
+        filename = request.form.get('filename') or session.get('staged_filename')
+        if not name or not filename:
+            return jsonify({
+                "status": "error",
+                "message": "Project name or file missing."
+            }), 400
+        file_id = staging.promote_staged_file(staged_file_id, filename)
+        if not file_id:
+            return jsonify({
+                "status": "error",
+                "message": "Staged file expired or missing."
+            }), 404
+        if session.get('staged_file_id') == staged_file_id:
+            session.pop('staged_file_id', None)
+            session.pop('staged_filename', None)
+        project_id = file_storage.create_project(name, None, filename, file_id=file_id)
+        return jsonify({
+            "status": "success",
+            "message": f"Project created with ID: {project_id}"
+        })
 
     if not name or not file:
         return jsonify({
@@ -167,40 +348,82 @@ def update_project():
     project_id = session.get('project_id')
     filename = session.get('filename').split('.')[0] + '.html'
 
+    annotation_ids = [annotation.get('annotation_id') for annotation in annotations or []
+                      if isinstance(annotation, dict) and 'annotation_id' in annotation]
+    if not all(is_valid_annotation_id(annotation_id) for annotation_id in annotation_ids):
+        return jsonify({"success": False, "error": "Annotation IDs must be integers"}), 400
+    # Checked before anything is written, the unique annotation index would reject the version half-saved
+    if len({int(annotation_id) for annotation_id in annotation_ids}) < len(annotation_ids):
+        return jsonify({"success": False, "error": "Annotation IDs must be unique"}), 400
+
     # Update the project version with the new HTML content and annotations
-    success = file_storage.update_version(project_id, filename, updated_html, annotations)
+    file_id = file_storage.update_version(project_id, filename, updated_html, annotations)
     
-    if success:
-        return jsonify({"success": True, "project_id": project_id})
+    if file_id:
+        # Later annotation edits go to the new version, which holds the current highlights
+        return jsonify({"success": True, "project_id": project_id, "file_id": str(file_id)})
     else:
         return jsonify({"success": False, "error": "Update failed"}), 500
 
 @app.route('/projects', methods=['GET'])
 def list_projects():
-    projects = file_storage.list_all_projects()
-    
-    # Convert ObjectId to string for each project
-    for project in projects:
-        project["_id"] = str(project["_id"])
-        
-    return jsonify({"projects": projects})
+    after = request.args.get('after')
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    if (after and not ObjectId.is_valid(after)) or limit < 1:
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+
+    # Project ids are already strings, converted inside the aggregation
+    projects, next_cursor = file_storage.list_all_projects(after, limit, request.args.get('prefix'))
+    return jsonify({"projects": projects, "next_cursor": next_cursor})
+
+@app.route('/search', methods=['GET'])
+def search_versions():
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    if not query or page < 1 or per_page < 1:
+        return jsonify({"error": "A query and valid pagination parameters are required"}), 400
+
+    hits, has_more = search.search(query, page, per_page)
+    return jsonify({"hits": hits, "page": page, "next_page": page + 1 if has_more else None})
 
 @app.route('/project_versions/<project_id>', methods=['GET'])
 def get_versions(project_id):
+    after = request.args.get('after')
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    if not ObjectId.is_valid(project_id) or (after and not ObjectId.is_valid(after)) or limit < 1:
+        return jsonify({"error": "Invalid project ID or pagination parameters"}), 400
+
+    # stor e project_id and file_id in session
     session.pop('filename', None)
     session.pop('file_type', None)
     session.pop('file_id', None)
     session['project_id'] = project_id
 
-    # stor e project_id and file_id in session
-    versions = file_storage.get_project_versions(project_id)
-    
-    
+    versions = file_storage.get_project_versions(project_id, after, limit)
 
-    # Convert ObjectId to string for each version's file_id
+    # Convert ObjectIds to strings for each version
     for version in versions:
+        version["_id"] = str(version["_id"])
+        version["project_id"] = str(version["project_id"])
         version["file_id"] = str(version["file_id"])
-    return jsonify({"versions": versions})
+    next_cursor = versions[-1]["_id"] if len(versions) == limit else None
+    return jsonify({"versions": versions, "next_cursor": next_cursor})
+
+@app.route('/project_versions/<project_id>/latest', methods=['GET'])
+def get_latest_version(project_id):
+    if not ObjectId.is_valid(project_id):
+        return jsonify({"error": "Invalid project ID"}), 400
+
+    version = file_storage.get_latest_version(project_id)
+    if not version:
+        return jsonify({"error": "Project has no versions"}), 404
+    return jsonify({
+        "_id": str(version["_id"]),
+        "project_id": str(version["project_id"]),
+        "file_id": str(version["file_id"]),
+        "version_date": version["version_date"]
+    })
 
 @app.route('/load_from_mongo', methods=['POST'])
 def load_from_mongo():
@@ -209,42 +432,43 @@ def load_from_mongo():
     if not file_id:
         return jsonify({'error': 'File ID not provided'}), 400
 
-    file_data = file_storage.get_file_by_id(file_id)
+    # Only the file document is read here; the content is streamed from /display,
+    # and /pages makes a local copy only if the file is converted
+    file_data = file_storage.get_file_info(file_id)
     
     if not file_data:
         return jsonify({'error': 'Document not found'}), 404
 
+    # The loaded file replaces whatever upload the session was working on
+    staging.discard_staged_file(session.pop('staged_file_id', None))
+    session.pop('staged_filename', None)
+    session.pop('temp_file_path', None)
+
     # Set the session variables
     session['filename'] = file_data['filename']
     file_type = file_data['filename'].split('.')[-1]
     session['file_type'] = file_type
     session['file_id'] = file_id
 
-    # Save the file temporarily to the server's file system
-    temp_file_path = save_temp_file(file_data)
-    session['temp_file_path'] = temp_file_path
     # Based on the filetype, determine the action to be taken on the frontend
     ext = '.' + file_type
+    url = url_for('display_file', file_id=str(file_data['file_id']))
+    # Annotations are fetched page by page from /annotations as the viewer renders them;
+    # new ones continue the numbering whatever the file type, so their ids stay unique
+    max_annotation_id = annotation_store.max_annotation_id(file_data['file_id'])
     if ext == '.html':
-        file_data['file_object'].seek(0)  # Resetting file pointer
-        content = file_data['file_object'].read().decode("utf-8")
-        
-        if not content:
-            return jsonify({'error': 'Retrieved HTML content is empty'}), 500
-        
-        annotations = file_data.get('annotations', [])
-
+        # The HTML itself is fetched from /display, which can send the stored gzip bytes as-is
         return jsonify({
             'filetype': 'html',
-            'content': content,
-            'annotations': annotations
+            'url': url,
+            'max_annotation_id': max_annotation_id
         })
 
-
     elif ext in ['.pdf', '.docx']:
         return jsonify({
             'filetype': file_type,
-            'url': url_for('display_file', file_id=str(file_data['file_object']._id))
+            'url': url,
+            'max_annotation_id': max_annotation_id
         })
 
     return "Unsupported file type", 400
@@ -254,71 +478,200 @@ def delete_file():
     file_id = request.form.get('file_id')
     if not file_id:
         return jsonify({'success': False, 'error': 'File ID not provided'}), 400
-    project_id = session.get('project_id')
-    success = file_storage.delete_file(file_id)
-    if success:
-        return jsonify({'success': True, 'project_id': project_id})
-    else:
+    try:
+        project_ids = file_storage.delete_files([file_id])
+    except Exception as e:
+        print(f"Error deleting file with ID {file_id}: {e}")
+        project_ids = None
+    if project_ids is None:
         return jsonify({'success': False, 'error': 'Failed to delete file'}), 500
 
+    # Report the owning project, falling back to the one open in the session
+    project_id = str(project_ids[0]) if project_ids else session.get('project_id')
+    return jsonify({'success': True, 'project_id': project_id})
+
+@app.route('/delete_files', methods=['POST'])
+def delete_files():
+    data = request.get_json(silent=True) or {}
+    file_ids = data.get('file_ids') or request.form.getlist('file_id')
+    if not file_ids or not isinstance(file_ids, list):
+        return jsonify({'success': False, 'error': 'File IDs not provided'}), 400
+
+    try:
+        project_ids = file_storage.delete_files(file_ids)
+    except Exception as e:
+        print(f"Error deleting files {file_ids}: {e}")
+        return jsonify({'success': False, 'error': 'Failed to delete files'}), 500
+    if project_ids is None:
+        return jsonify({'success': False, 'error': 'Files not found'}), 404
+    return jsonify({'success': True, 'project_ids': [str(project_id) for project_id in project_ids]})
+
 @app.route('/delete_project', methods=['POST'])
 def delete_project():
     project_id = request.form.get('project_id')
-    if not project_id:
+    if not project_id or not ObjectId.is_valid(project_id):
         return jsonify({'success': False, 'error': 'Project ID not provided'}), 400
 
-    success = file_storage.delete_project(project_id)
-    if success:
-        return jsonify({'success': True})
-    else:
-        return jsonify({'success': False, 'error': 'Failed to delete project'}), 500
+    # The project disappears immediately, its versions are cleaned up in the background
+    if not project_deletion.request_project_deletion(project_id):
+        return jsonify({'success': False, 'error': 'Failed to delete project'}), 404
+    return jsonify({
+        'success': True,
+        'status_url': url_for('project_deletion_status', project_id=project_id)
+    }), 202
+
+@app.route('/delete_project/<project_id>', methods=['GET'])
+def project_deletion_status(project_id):
+    # Pick up deletions abandoned by a recycled worker before reporting on them
+    project_deletion.resume_pending_deletions()
+    deletion = project_deletion.get_deletion_status(project_id)
+    if not deletion:
+        return jsonify({'success': False, 'error': 'No deletion found for this project'}), 404
+    return jsonify({
+        'success': True,
+        'status': deletion['status'],
+        'total': deletion.get('total', 0),
+        'deleted': deletion.get('deleted', 0),
+        'error': deletion.get('error')
+    })
 
 
-# ---------- FILE CONVERSION ROUTE ----------
-# route is used to convert the file to html for annotation
+# ---------- FILE CONVERSION ROUTES ----------
+# PDFs are converted to HTML for annotation off the request threads: uploads through a
+# background job the client polls, stored PDFs page by page as the annotator scrolls
 
-@app.route('/annotate', methods=['POST'])
-def annotate():
-    file_name = session.get('filename')
-    temp_file_path = session.get('temp_file_path')
+# Background conversions: returns a job id right away, the client polls for progress
 
+@app.route('/conversions', methods=['POST'])
+def submit_conversion():
+    file_name = session.get('filename') or session.get('staged_filename')
     if not file_name or not file_name.endswith('.pdf'):
-        return "No valid PDF filename found in session", 404
+        return jsonify({'success': False, 'error': 'No valid PDF filename found in session'}), 404
+
+    if session.get('file_id'):
+        source = {'kind': 'file', 'id': session['file_id']}
+    elif session.get('staged_file_id'):
+        source = {'kind': 'staged', 'id': session['staged_file_id']}
+    elif session.get('temp_file_path'):
+        source = {'kind': 'path', 'id': session['temp_file_path']}
+    else:
+        return jsonify({'success': False, 'error': f'File {file_name} does not exist on the server'}), 404
 
-    temp_html_file_path = os.path.join(os.path.dirname(temp_file_path), "temp.html")
+    job_id = conversion.submit_conversion(source, file_name)
+    if job_id is None:
+        response = jsonify({'success': False, 'error': 'Conversion queue is full, try again shortly'})
+        response.headers['Retry-After'] = '10'
+        return response, 503
 
-    # Validate that the file indeed exists
-    if not os.path.exists(temp_file_path):
-        return f"File {file_name} does not exist on the server", 404
+    return jsonify({
+        'success': True,
+        'job_id': str(job_id),
+        'status_url': url_for('conversion_status', job_id=str(job_id))
+    }), 202
+
+@app.route('/conversions/<job_id>', methods=['GET'])
+def conversion_status(job_id):
+    job = conversion.get_conversion_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Conversion job not found'}), 404
+
+    status = {
+        'job_id': str(job['_id']),
+        'status': job['status'],
+        'progress': job.get('progress', 0)
+    }
+    if job['status'] == 'done':
+        session['filetype'] = '.html'  # Update the session's filetype to html
+        status['url'] = url_for('conversion_result', job_id=str(job['_id']))
+    elif job['status'] == 'failed':
+        status['error'] = job.get('error')
+    return jsonify(status)
+
+@app.route('/conversions/<job_id>/result', methods=['GET'])
+def conversion_result(job_id):
+    # The result is the conversion cache's gzip blob, sent as-is to clients that accept it
+    blob = conversion.get_conversion_result(job_id)
+    if blob is None:
+        return jsonify({'success': False, 'error': 'Conversion result not found or expired'}), 404
+    content_encoding = file_storage.blob_encoding(blob)
+    if content_encoding not in accepted_encodings():
+        blob, content_encoding = file_storage.decode_blob(blob), None
+    response = send_gridfs_file(blob, 'text/html', content_encoding)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Paged conversion: pages are converted on demand so the first ones render right away
+
+@app.route('/pages/<file_id>', methods=['GET'])
+def get_pages(file_id):
+    start = request.args.get('start', 1, type=int)
+    count = min(request.args.get('count', 5, type=int), conversion.MAX_PAGES_PER_REQUEST)
+    if start < 1 or count < 1:
+        return jsonify({'success': False, 'error': 'Invalid page range'}), 400
+
+    file_doc = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)}, {'filename': 1}) if ObjectId.is_valid(file_id) else None
+    if not file_doc or not file_doc['filename'].endswith('.pdf'):
+        return jsonify({'success': False, 'error': 'PDF document not found'}), 404
 
     try:
-        subprocess.run(["pdftohtml", "-s", "-noframes", temp_file_path, temp_html_file_path], check=True)
-    except subprocess.CalledProcessError as e:
-        return f"Conversion failed: {e}", 500
+        page_count, fragments = conversion.get_pdf_pages(file_id, start, count)
+    except conversion.ConversionBusy as e:
+        response = jsonify({'success': False, 'error': str(e)})
+        response.headers['Retry-After'] = '2'
+        return response, 503
+    except conversion.ConversionError as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
+    session['filetype'] = '.html'  # Update the session's filetype to html
+    next_page = start + len(fragments)
+    return jsonify({
+        'success': True,
+        'page_count': page_count,
+        'pages': [{'page': page, 'html': html} for page, html in fragments],
+        'next': next_page if next_page <= page_count else None
+    })
+
+
+# ---------- BULK IMPORT ROUTES ----------
+# An archive of reports becomes one project per file; the import runs in the background and
+# is picked up by another worker if the one running it goes away
+
+@app.route('/imports', methods=['POST'])
+def submit_import():
+    archive = request.files.get('archive')
+    staged_file_id = request.form.get('staged_file_id')
+    if not archive and not staged_file_id:
+        return jsonify({'success': False, 'error': 'Archive missing'}), 400
     try:
-        with open(temp_html_file_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-    except Exception as e:
-        return f"Failed to read HTML file: {e}", 500
-    finally:
-        if os.path.exists(temp_html_file_path):
-            os.remove(temp_html_file_path)
-
-    image_dir = os.path.dirname(temp_html_file_path)
-    image_refs = re.findall(r'src="([^"]+)"', html_content)
-
-    for img in image_refs:
-        img_path = os.path.join(image_dir, img)
-        if os.path.exists(img_path):
-            with open(img_path, "rb") as img_file:
-                img_base64 = base64.b64encode(img_file.read()).decode()
-            os.remove(img_path)
-            html_content = html_content.replace(f'src="{img}"', f'src="data:image/png;base64,{img_base64}"')
+        if archive:
+            import_id = bulk_import.submit_import(archive.filename, stream=archive.stream)
+        else:
+            # Archives larger than a request body arrive through a resumable upload first
+            import_id = bulk_import.submit_import(request.form.get('filename') or 'archive', staged_id=staged_file_id)
+    except bulk_import.ArchiveError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
 
-    session['filetype'] = '.html'  # Update the session's filetype to html
+    return jsonify({
+        'success': True,
+        'import_id': str(import_id),
+        'status_url': url_for('import_status', import_id=str(import_id))
+    }), 202
+
+@app.route('/imports/<import_id>', methods=['GET'])
+def import_status(import_id):
+    job = bulk_import.get_import(import_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Import not found'}), 404
 
-    return html_content
+    return jsonify({
+        'import_id': str(job['_id']),
+        'filename': job.get('filename'),
+        'status': job['status'],
+        'counts': job.get('counts', {}),
+        'entries': job.get('entries', []),
+        'error': job.get('error')
+    })
 
 
 # ---------- ATTACK FLOW ROUTES ----------
@@ -329,6 +682,74 @@ def open_attack_flow():
 
 
 # ---------- Annotation Routes ----------
+# Incremental edits: each request carries a single annotation instead of a whole new version
+
+def is_valid_document_id(document_id):
+    return ObjectId.is_valid(document_id) and mongo.db.fs.files.find_one({'_id': ObjectId(document_id)}, {'_id': 1})
+
+def is_valid_annotation_id(annotation_id):
+    if isinstance(annotation_id, bool):
+        return False
+    try:
+        int(annotation_id)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+@app.route('/annotations/<document_id>', methods=['GET'])
+def list_annotations(document_id):
+    if not is_valid_document_id(document_id):
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+
+    # ?start=&end= or ?page= return only what the viewer is showing,
+    # ?page=none the annotations saved without a page
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    if request.args.get('page') == 'none':
+        return jsonify({'annotations': annotation_store.get_page_annotations(document_id, None)})
+    page = request.args.get('page', type=int)
+    if start is not None or end is not None:
+        if start is None or end is None or end <= start:
+            return jsonify({'success': False, 'error': 'start and end must describe a non-empty range'}), 400
+        return jsonify({'annotations': annotation_store.get_annotations_in_range(document_id, start, end)})
+    if page is not None:
+        return jsonify({'annotations': annotation_store.get_page_annotations(document_id, page)})
+    return jsonify({'annotations': annotation_store.get_annotations(document_id)})
+
+@app.route('/annotations/<document_id>', methods=['POST'])
+def add_annotation(document_id):
+    annotation = request.get_json(silent=True)
+    if not isinstance(annotation, dict) or not is_valid_annotation_id(annotation.get('annotation_id')):
+        return jsonify({'success': False, 'error': 'Invalid data received'}), 400
+    if not is_valid_document_id(document_id):
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+
+    if not annotation_store.add_annotation(document_id, annotation):
+        return jsonify({'success': False, 'error': 'Annotation ID already exists'}), 409
+    search.annotations_changed(document_id)
+    return jsonify({'success': True, 'annotation_id': annotation['annotation_id']}), 201
+
+@app.route('/annotations/<document_id>/<int:annotation_id>', methods=['PATCH'])
+def update_annotation(document_id, annotation_id):
+    changes = request.get_json(silent=True)
+    if not changes or not ObjectId.is_valid(document_id):
+        return jsonify({'success': False, 'error': 'Invalid data received'}), 400
+
+    annotation = annotation_store.update_annotation(document_id, annotation_id, changes)
+    if not annotation:
+        return jsonify({'success': False, 'error': 'Annotation not found'}), 404
+    search.annotations_changed(document_id)
+    return jsonify({'success': True, 'annotation': annotation})
+
+@app.route('/annotations/<document_id>/<int:annotation_id>', methods=['DELETE'])
+def delete_annotation(document_id, annotation_id):
+    if not ObjectId.is_valid(document_id):
+        return jsonify({'success': False, 'error': 'Invalid document ID'}), 400
+
+    if not annotation_store.delete_annotation(document_id, annotation_id):
+        return jsonify({'success': False, 'error': 'Annotation not found'}), 404
+    search.annotations_changed(document_id)
+    return jsonify({'success': True})
 
 
 # ---------- DEBUGGING ----------
@@ -336,8 +757,11 @@ def open_attack_flow():
 @app.route('/clear_database', methods=['POST'])
 def clear_database():
     try:
-        # Clear the projects collection
+        # Clear the projects and their versions
         mongo.db.projects.delete_many({})
+        mongo.db.project_versions.delete_many({})
+        mongo.db.project_deletions.delete_many({})
+        mongo.db.imports.delete_many({})
 
         # Clear the fs.files collection
         mongo.db.fs.files.delete_many({})
@@ -345,6 +769,19 @@ def clear_database():
         # Clear the fs.chunks collection
         mongo.db.fs.chunks.delete_many({})
 
+        # Clear the annotations collection, the search index and the conversion cache
+        mongo.db.annotations.delete_many({})
+        mongo.db.annotation_spans.delete_many({})
+        mongo.db[search.SEARCH_COLLECTION].delete_many({})
+        mongo.db.conversion_cache.delete_many({})
+        mongo.db.conversion_jobs.delete_many({})
+
+        # Clear the content-addressed blobs and any staged uploads
+        file_storage.clear_blobs()
+        for bucket in (file_storage.ASSET_BUCKET, staging.STAGING_BUCKET):
+            mongo.db[f'{bucket}.files'].delete_many({})
+            mongo.db[f'{bucket}.chunks'].delete_many({})
+
         return jsonify({'success': True, 'message': 'Database cleared successfully!'})
     except Exception as e:
         print(f"Error clearing database: {e}")
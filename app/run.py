@@ -1,8 +1,9 @@
 import sys
 sys.path.append('..')
 
-from app import app
-from app import routes  # This line is important to ensure your routes are registered
+from app import app, init_database
+from app import routes, commands  # This line is important to ensure your routes are registered
 
 if __name__ == "__main__":
+    init_database()
     app.run(debug=True, host="0.0.0.0", port=5002)
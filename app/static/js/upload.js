@@ -2,6 +2,12 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
 
 let annotationCounter = 0; // Define a global counter for annotations
 var localAnnotations = [];
+var currentFileId = null; // Stored document the annotations belong to
+var pagedDocument = null; // Paged conversion state: { fileId, next, observer }
+var annotatedPages = new Set(); // Pages whose annotations have been fetched
+var annotationPageObserver = null; // Fetches annotations as the pages of a stored HTML scroll into view
+const PAGES_PER_REQUEST = 5;
+const CONVERSION_POLL_TIMEOUT_MS = 10 * 60 * 1000; // Give up on a background conversion after ten minutes
 
 // ---------- Viewer Initialization Functions ----------
 
@@ -43,7 +49,8 @@ function initializePDFViewer(url) {
     }
 
     console.log("Showing PDF for URL: ", url);
-    pdfjsLib.getDocument(url).promise.then(function (pdfDoc_) {
+    // The server answers Range requests, so only fetch the byte ranges each page needs
+    pdfjsLib.getDocument({ url: url, disableAutoFetch: true }).promise.then(function (pdfDoc_) {
         pdfDoc = pdfDoc_;
 
         // Display each page
@@ -113,10 +120,34 @@ function saveFile(event) {
 function createProject(event) {
     event.preventDefault();
 
+    var file = document.getElementById("initialfile").files[0];
     var formData = new FormData();
     formData.append('projectname', document.getElementById("projectname").value);
-    formData.append('initialfile', document.getElementById("initialfile").files[0]);
 
+    if (file && file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        // Large reports go up in resumable chunks, then the project is created from the staged file
+        var messageElement = document.getElementById("projectCreationMessage");
+        uploadInChunks(file, function(sent) {
+            messageElement.style.color = "black";
+            messageElement.textContent = "Uploading... " + Math.floor(sent * 100 / file.size) + "%";
+        })
+            .then(uploadId => {
+                formData.append('staged_file_id', uploadId);
+                formData.append('filename', file.name);
+                sendCreateProject(formData);
+            })
+            .catch(error => {
+                messageElement.textContent = error.message;
+                messageElement.style.color = "red";
+            });
+        return;
+    }
+
+    formData.append('initialfile', file);
+    sendCreateProject(formData);
+}
+
+function sendCreateProject(formData) {
     var xhr = new XMLHttpRequest();
     xhr.open("POST", "/create_project", true);
     xhr.onreadystatechange = function() {
@@ -135,14 +166,100 @@ function createProject(event) {
     xhr.send(formData);
 }
 
-function loadProjects() {
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_RETRIES = 5;
+
+function sha256Hex(buffer) {
+    if (!window.crypto || !window.crypto.subtle) {
+        // Checksums need a secure context; the server accepts chunks without one
+        return Promise.resolve(null);
+    }
+    return crypto.subtle.digest('SHA-256', buffer).then(digest =>
+        Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('')
+    );
+}
+
+function uploadInChunks(file, onProgress) {
+    // Resolves with the staged file id once every chunk is stored and the upload is finalized
+    var retries = 0;
+
+    function sendFrom(uploadUrl, offset, chunkSize) {
+        if (offset >= file.size) {
+            return fetch(uploadUrl + '/finalize', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({})
+            }).then(response => response.json().then(data => {
+                if (response.status == 409) {
+                    return sendFrom(uploadUrl, data.offset, chunkSize);
+                }
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                return data.staged_file_id;
+            }));
+        }
+
+        var chunk = file.slice(offset, offset + chunkSize);
+        return chunk.arrayBuffer()
+            .then(buffer => sha256Hex(buffer).then(checksum => {
+                var headers = { 'Upload-Offset': String(offset) };
+                if (checksum) {
+                    headers['Upload-Checksum'] = checksum;
+                }
+                return fetch(uploadUrl, { method: 'PATCH', headers: headers, body: buffer });
+            }))
+            .then(response => response.json().then(data => {
+                if (response.ok) {
+                    retries = 0;
+                    onProgress(data.offset);
+                    return sendFrom(uploadUrl, data.offset, chunkSize);
+                }
+                if ((response.status == 409 || response.status == 422) && retries++ < UPLOAD_RETRIES) {
+                    // The server tells us which byte it expects next
+                    return sendFrom(uploadUrl, data.offset, chunkSize);
+                }
+                throw new Error(data.error);
+            }), error => {
+                if (retries++ >= UPLOAD_RETRIES) {
+                    throw error;
+                }
+                // Connection dropped: ask the server how far it got and resume from there
+                return fetch(uploadUrl)
+                    .then(response => response.json())
+                    .then(data => sendFrom(uploadUrl, data.offset, chunkSize));
+            });
+    }
+
+    return fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            return sendFrom(data.upload_url, data.offset, Math.min(UPLOAD_CHUNK_SIZE, data.max_chunk_size));
+        });
+}
+
+function loadProjects(after) {
     var xhr = new XMLHttpRequest();
-    xhr.open("GET", "/projects", true);
+    xhr.open("GET", "/projects" + (after ? "?after=" + after : ""), true);
     xhr.onreadystatechange = function() {
         if (xhr.readyState == 4 && xhr.status == 200) {
             var response = JSON.parse(xhr.responseText);
             var projectListElement = document.getElementById("projectList");
-            projectListElement.innerHTML = "";
+            var moreButton = document.getElementById("moreProjectsButton");
+            if (moreButton) {
+                moreButton.remove();
+            }
+            if (!after) {
+                projectListElement.innerHTML = "";
+            }
 
             // Populate projects
             response.projects.forEach(function(project) {
@@ -165,25 +282,46 @@ function loadProjects() {
                     delete_project(project._id);
                 };
 
+                var summary = document.createElement("span");
+                summary.textContent = " (" + project.version_count + " versions)";
+
                 listItem.appendChild(projectButton);
+                listItem.appendChild(summary);
                 listItem.appendChild(deleteButton);
                 projectListElement.appendChild(listItem);
             });
+
+            // Fetch the next page of projects on demand
+            if (response.next_cursor) {
+                var loadMore = document.createElement("button");
+                loadMore.id = "moreProjectsButton";
+                loadMore.textContent = "Load more";
+                loadMore.onclick = function() {
+                    loadProjects(response.next_cursor);
+                };
+                projectListElement.after(loadMore);
+            }
         }
     };
     xhr.send();
 }
 
-function displayVersions(projectId) {
+function displayVersions(projectId, after) {
     var xhr = new XMLHttpRequest();
-    xhr.open("GET", "/project_versions/" + projectId, true);
+    xhr.open("GET", "/project_versions/" + projectId + (after ? "?after=" + after : ""), true);
     xhr.onreadystatechange = function() {
         if (xhr.readyState == 4 && xhr.status == 200) {
             var response = JSON.parse(xhr.responseText);
             var versionListElement = document.getElementById("versionList");
+            var moreButton = document.getElementById("moreVersionsButton");
+            if (moreButton) {
+                moreButton.remove();
+            }
             
             document.getElementById("versionsDetails").open = true;
-            versionListElement.innerHTML = "";  
+            if (!after) {
+                versionListElement.innerHTML = "";
+            }
 
             response.versions.forEach(function(version) {
                 
@@ -217,7 +355,17 @@ function displayVersions(projectId) {
             
                 document.getElementById("versionList").appendChild(versionItem);
             });
-            
+
+            // Long histories are fetched a page at a time
+            if (response.next_cursor) {
+                var loadMore = document.createElement("button");
+                loadMore.id = "moreVersionsButton";
+                loadMore.textContent = "Load more";
+                loadMore.onclick = function() {
+                    displayVersions(projectId, response.next_cursor);
+                };
+                versionListElement.after(loadMore);
+            }
         }
     };
     xhr.send();
@@ -226,6 +374,9 @@ function displayVersions(projectId) {
 function loadFileFromDB(file_id) {
     localAnnotations = [];
     annotationCounter = 0;
+    currentFileId = file_id;
+    stopPagedConversion();
+    resetAnnotationPages();
     fetch(`/load_from_mongo`, {
         method: 'POST',
         headers: {
@@ -242,6 +393,8 @@ function loadFileFromDB(file_id) {
     .then(data => {
         // clear the annotations container
         resetAnnotationsContainer();
+        // New annotations continue the stored numbering, whatever the file type
+        annotationCounter = data.max_annotation_id || 0;
 
         const pdfContainer = document.getElementById("pdf-pages");
         console.log("Loading file: ", data.filetype);
@@ -250,21 +403,19 @@ function loadFileFromDB(file_id) {
         } else if (data.filetype === "docx") {
             initializeWordViewer(data.url);
         } else if (data.filetype === "html") {
-            console.log("HTML content:", data.content);
-            pdfContainer.innerHTML = data.content;
-          
-            // Set the local annotations from the retrieved data
-            localAnnotations = data.annotations;
-
-            // Populate the annotationsContainer with loaded annotations
-            localAnnotations.forEach(annotation => {
-                addVisualRepresentationToAnnotationsContainer(annotation);
-            });
-
-            // set the annotation counter
-            if (localAnnotations.length > 0) {
-                annotationCounter = Math.max(...localAnnotations.map(annotation => annotation.annotation_id));
-            }
+            // Annotations are fetched per page once the HTML is in place
+            // The HTML is served separately (gzip-encoded when stored compressed)
+            return fetch(data.url)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Failed to fetch the HTML content');
+                    }
+                    return response.text();
+                })
+                .then(content => {
+                    pdfContainer.innerHTML = content;
+                    observeAnnotationPages(pdfContainer);
+                });
         } else {
             console.error("Unsupported file type");
         }
@@ -357,6 +508,8 @@ document.addEventListener("DOMContentLoaded", () => {
 });
 
 function clearAction() {
+    stopPagedConversion();
+    resetAnnotationPages();
     resetAnnotationsContainer();
     document.getElementById("actionButtons").style.display = "none";
     document.getElementById("versionList").style.display = "none";
@@ -389,14 +542,27 @@ function annotateAction() {
             if (fileInfo.filetype === '.docx' || fileInfo.filetype === '.html') {
                 // If it's a docx or html, copy the content from pdf-container to html-container
                 htmlContainer.innerHTML = pdfContainer.innerHTML;
+            } else if (fileInfo.filetype === '.pdf' && fileInfo.file_id !== 'Empty') {
+                // Stored PDFs are converted page by page as the annotator scrolls
+                startPagedConversion(fileInfo.file_id, htmlContainer);
             } else if (fileInfo.filetype === '.pdf') {
-                // If it's a PDF, send request to convert the PDF to HTML
-                fetch('/annotate', { method: 'POST' })
-                    .then(response => response.text())
+                // If it's a PDF, queue a background conversion to HTML and poll until it is done
+                htmlContainer.innerHTML = '<h2>Converting...</h2>';
+                fetch('/conversions', { method: 'POST' })
+                    .then(response => response.json())
+                    .then(job => {
+                        if (!job.success) {
+                            throw new Error(job.error);
+                        }
+                        return pollConversion(job.status_url, htmlContainer);
+                    })
                     .then(htmlContent => {
                         htmlContainer.innerHTML = htmlContent;
                     })
-                    .catch(error => console.error('Conversion Error:', error));
+                    .catch(error => {
+                        htmlContainer.innerHTML = '';
+                        console.error('Conversion Error:', error);
+                    });
             } else {
                 console.error('Unsupported file type:', fileInfo.filetype);
             }
@@ -408,6 +574,175 @@ function annotateAction() {
     annotationsContainer.style.display = 'block'; // Show the annotations container
 }
 
+// ---------- Paged Conversion ----------
+
+function startPagedConversion(fileId, container) {
+    stopPagedConversion();
+    container.innerHTML = '';
+
+    const sentinel = document.createElement('div');
+    sentinel.className = 'page-sentinel';
+    container.appendChild(sentinel);
+
+    pagedDocument = { fileId: fileId, next: 1, loading: null, container: container, sentinel: sentinel };
+    // Fetch the next batch whenever the end of the rendered pages scrolls into view
+    pagedDocument.observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPages();
+        }
+    }, { rootMargin: '800px' });
+    pagedDocument.observer.observe(sentinel);
+}
+
+function stopPagedConversion() {
+    if (pagedDocument) {
+        pagedDocument.observer.disconnect();
+        pagedDocument.sentinel.remove();
+        pagedDocument = null;
+    }
+}
+
+function loadNextPages() {
+    const state = pagedDocument;
+    if (!state || state.next === null) return Promise.resolve();
+    if (state.loading) return state.loading;
+
+    state.loading = fetch(`/pages/${state.fileId}?start=${state.next}&count=${PAGES_PER_REQUEST}`)
+        .then(response => {
+            if (response.status === 503) {
+                // The server is busy converting other documents, ask for the same pages again shortly
+                const delay = (parseInt(response.headers.get('Retry-After'), 10) || 2) * 1000;
+                return new Promise(resolve => setTimeout(resolve, delay)).then(() => null);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data === null) {
+                state.loading = null;
+                return state === pagedDocument ? loadNextPages() : undefined;
+            }
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            data.pages.forEach(page => {
+                state.sentinel.insertAdjacentHTML('beforebegin', page.html);
+            });
+            loadPageAnnotations(data.pages.map(page => page.page));
+            state.next = data.next;
+            state.loading = null;
+            if (state.next === null) {
+                stopPagedConversion();
+            }
+        })
+        .catch(error => {
+            state.loading = null;
+            console.error('Page loading error:', error);
+            throw error;
+        });
+    return state.loading;
+}
+
+function loadRemainingPages() {
+    // A version must contain the whole document, so fetch any pages not yet scrolled to
+    if (!pagedDocument) return Promise.resolve();
+    return loadNextPages().then(loadRemainingPages);
+}
+
+// ---------- Annotations By Page ----------
+
+function mergeAnnotations(annotations) {
+    annotations.forEach(annotation => {
+        if (!localAnnotations.some(anno => anno.annotation_id === annotation.annotation_id)) {
+            localAnnotations.push(annotation);
+            addVisualRepresentationToAnnotationsContainer(annotation);
+        }
+    });
+}
+
+function fetchAnnotations(query) {
+    if (!currentFileId) return Promise.resolve();
+    return fetch(`/annotations/${currentFileId}${query}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Loading annotations failed with status ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => mergeAnnotations(data.annotations));
+}
+
+function showAnnotations(query) {
+    fetchAnnotations(query).catch(error => console.error('Annotation loading error:', error));
+}
+
+function loadPageAnnotations(pages) {
+    // Only the annotations of rendered pages are fetched, each page once
+    pages.filter(page => !annotatedPages.has(page)).forEach(page => {
+        annotatedPages.add(page);
+        showAnnotations(`?page=${page}`);
+    });
+}
+
+function observeAnnotationPages(container) {
+    const pages = container.querySelectorAll('.pdf-page[data-page]');
+    if (pages.length === 0) {
+        // Documents without pages have their annotations fetched in one go
+        showAnnotations('');
+        return;
+    }
+    // Annotations recorded before pages were tracked have no page
+    showAnnotations('?page=none');
+    annotationPageObserver = new IntersectionObserver(entries => {
+        loadPageAnnotations(entries.filter(entry => entry.isIntersecting)
+            .map(entry => parseInt(entry.target.dataset.page, 10)));
+    }, { rootMargin: '800px' });
+    pages.forEach(page => annotationPageObserver.observe(page));
+}
+
+function resetAnnotationPages() {
+    annotatedPages = new Set();
+    if (annotationPageObserver) {
+        annotationPageObserver.disconnect();
+        annotationPageObserver = null;
+    }
+}
+
+function loadAllAnnotations() {
+    // A new version carries the full set, including pages that were never scrolled to
+    return fetchAnnotations('');
+}
+
+function pollConversion(statusUrl, container, deadline) {
+    // Jobs of a recycled worker are taken over by another one, but never wait forever
+    deadline = deadline || Date.now() + CONVERSION_POLL_TIMEOUT_MS;
+    return fetch(statusUrl)
+        .then(response => response.json().then(job => {
+            if (!response.ok) {
+                throw new Error(job.error || `Conversion status failed with status ${response.status}`);
+            }
+            return job;
+        }))
+        .then(job => {
+            if (job.status === 'done') {
+                return fetch(job.url).then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Fetching the conversion failed with status ${response.status}`);
+                    }
+                    return response.text();
+                });
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error);
+            }
+            if (Date.now() > deadline) {
+                throw new Error('The conversion is taking too long, try again later');
+            }
+            container.innerHTML = `<h2>Converting... ${job.progress}%</h2>`;
+            return new Promise(resolve => setTimeout(resolve, 1000))
+                .then(() => pollConversion(statusUrl, container, deadline));
+        });
+}
+
 function projectsDetailsAction() {
     const versionsDetails = document.getElementById("versionsDetails");
     if (this.open) {
@@ -476,14 +811,15 @@ function addAnnotation() {
     const tag = selectedAnnotation[0];
     const tagCode = selectedAnnotation[1];
     annotationCounter++;  // Increment the counter for each new annotation
+    const position = selectionPosition(window.getSelection().getRangeAt(0));
 
-    localAnnotations.push({
+    localAnnotations.push(Object.assign({
         annotation_id: annotationCounter,
         selected_text: selectedText,
         tag: tag,
         code: tagCode,
         related_annotation_ids: []
-    });
+    }, position));
 
     addVisualRepresentationToAnnotationsContainer({
         annotation_id: annotationCounter,
@@ -502,9 +838,51 @@ function addAnnotation() {
     range.surroundContents(span);
     window.getSelection().removeAllRanges();  // Deselect the text
 
+    persistAnnotation('POST', localAnnotations[localAnnotations.length - 1]);
     refreshAnnotationsDisplay();
 }
 
+function selectionPosition(range) {
+    // Character offsets of the selection in the document text, and the page it starts on,
+    // so the server can return only the annotations of the part being viewed
+    const container = document.getElementById("html-pages");
+    const before = document.createRange();
+    before.setStart(container, 0);
+    before.setEnd(range.startContainer, range.startOffset);
+    const start = before.toString().length;
+    const position = { start: start, end: start + range.toString().length };
+
+    const node = range.startContainer;
+    const element = node.nodeType === Node.ELEMENT_NODE ? node : node.parentElement;
+    const page = element ? element.closest(".pdf-page") : null;
+    if (page) {
+        position.page = parseInt(page.dataset.page, 10);
+    }
+    return position;
+}
+
+function persistAnnotation(method, annotation, changes) {
+    // Send a single annotation change to the server instead of a whole new version
+    if (!currentFileId) return;
+
+    let url = `/annotations/${currentFileId}`;
+    if (method !== 'POST') {
+        url += `/${annotation.annotation_id}`;
+    }
+    const options = { method: method, headers: { 'Content-Type': 'application/json' } };
+    if (method !== 'DELETE') {
+        options.body = JSON.stringify(method === 'POST' ? annotation : changes);
+    }
+
+    fetch(url, options)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Annotation ${method} failed with status ${response.status}`);
+            }
+        })
+        .catch(error => console.error('Annotation Error:', error));
+}
+
 function addVisualRepresentationToAnnotationsContainer(annotation) {
     const container = document.getElementById('annotationsContainer');
     
@@ -587,6 +965,12 @@ function createRelatedSection(annotation) {
                 annotation.related_annotation_ids.includes(anno.annotation_id)) {
                 checkbox.checked = true;
             }
+            checkbox.addEventListener('change', function() {
+                const checkedValues = Array.from(relatedSection.querySelectorAll('input[type="checkbox"]'))
+                    .filter(box => box.checked)
+                    .map(box => parseInt(box.value));
+                persistAnnotation('PATCH', annotation, { related_annotation_ids: checkedValues });
+            });
 
             const label = document.createElement('label');
             label.htmlFor = checkbox.id;
@@ -610,6 +994,7 @@ function createRemoveButton(annotation) {
         if (index > -1) {
             localAnnotations.splice(index, 1);
         }
+        persistAnnotation('DELETE', annotation);
         removeHighlightedTextById(annotation.annotation_id);
     });
     return removeButton;
@@ -659,21 +1044,26 @@ function removeHighlightedTextById(annotationId) {
 
 function updateAction() {
     updateRelatedAnnotationsBasedOnCheckboxes();
-    const updatedHtmlContent = document.getElementById("html-pages").innerHTML;
 
-    fetch('/update_project', {
+    loadRemainingPages()
+    .then(loadAllAnnotations)
+    .then(() => fetch('/update_project', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify({
-            updatedHtml: updatedHtmlContent,
+            updatedHtml: document.getElementById("html-pages").innerHTML,
             annotations: localAnnotations  // Send the local annotations
         })
-    })
+    }))
     .then(response => response.json())
     .then(data => {
         if(data.success) {
+            // Annotation edits from now on belong to the version just saved
+            if (data.file_id) {
+                currentFileId = data.file_id;
+            }
             alert("Updated successfully!");
             if (data.project_id) {
                 displayVersions(data.project_id);
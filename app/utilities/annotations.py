@@ -0,0 +1,163 @@
+from bson import ObjectId
+from pymongo import ReturnDocument
+from .. import mongo
+
+# Annotations live in their own collection, one document per annotation,
+# keyed by the file they belong to (document_id) and the client-side annotation_id.
+# start and end are character offsets of the highlighted text in the document and page
+# is the page it starts on. Annotations are indexed by (document_id, start), and the
+# annotation_spans collection keeps the longest span of each document, so the annotations
+# overlapping a range are found by scanning only the starts within that distance of it.
+ANNOTATION_FIELDS = ('selected_text', 'tag', 'code', 'related_annotation_ids')
+POSITION_FIELDS = ('start', 'end', 'page')
+
+def _collection():
+    return mongo.db.annotations
+
+def _clean(annotation):
+    # Only keep the fields the annotator sends, never client-supplied keys
+    cleaned = {key: annotation[key] for key in ANNOTATION_FIELDS if key in annotation}
+    try:
+        position = {key: int(annotation[key]) for key in POSITION_FIELDS if annotation.get(key) is not None}
+    except (TypeError, ValueError):
+        return cleaned
+    # Offsets only count as a pair describing a non-empty span
+    if ('start' in position) != ('end' in position) or position.get('end', 1) <= position.get('start', 0):
+        position.pop('start', None)
+        position.pop('end', None)
+    cleaned.update(position)
+    return cleaned
+
+def _span(annotation):
+    return annotation['end'] - annotation['start'] if 'start' in annotation and 'end' in annotation else 0
+
+def _record_span(document_id, span):
+    # The longest span only grows; after deletions it is an over-estimate, which is still correct
+    if span:
+        mongo.db.annotation_spans.update_one({'_id': document_id}, {'$max': {'max_span': span}}, upsert=True)
+
+def get_annotations(document_id):
+    """
+    Return all annotations of a document ordered by annotation_id.
+    Annotations still embedded in legacy GridFS metadata are migrated on first read.
+    """
+    document_id = ObjectId(document_id)
+    annotations = list(_collection().find({'document_id': document_id}, {'_id': 0, 'document_id': 0}).sort('annotation_id', 1))
+    if annotations:
+        return annotations
+
+    file_doc = mongo.db.fs.files.find_one({'_id': document_id, 'metadata.annotations.0': {'$exists': True}},
+                                          {'metadata.annotations': 1})
+    if not file_doc:
+        return []
+    legacy = file_doc['metadata']['annotations']
+    set_annotations(document_id, legacy)
+    mongo.db.fs.files.update_one({'_id': document_id}, {'$unset': {'metadata.annotations': ''}})
+    return get_annotations(document_id)
+
+def set_annotations(document_id, annotations):
+    """
+    Replace every annotation of a document, used when a new version is saved with its full set.
+    """
+    document_id = ObjectId(document_id)
+    _collection().delete_many({'document_id': document_id})
+    docs = [dict(_clean(annotation), document_id=document_id, annotation_id=int(annotation['annotation_id']))
+            for annotation in annotations or [] if 'annotation_id' in annotation]
+    if docs:
+        _collection().insert_many(docs, ordered=False)
+    mongo.db.annotation_spans.replace_one(
+        {'_id': document_id},
+        {'_id': document_id, 'max_span': max([_span(doc) for doc in docs], default=0)},
+        upsert=True
+    )
+
+def add_annotation(document_id, annotation):
+    """
+    Insert a single annotation. Returns False if the annotation_id is already taken.
+    """
+    doc = dict(_clean(annotation), document_id=ObjectId(document_id), annotation_id=int(annotation['annotation_id']))
+    doc.setdefault('related_annotation_ids', [])
+    result = _collection().update_one(
+        {'document_id': doc['document_id'], 'annotation_id': doc['annotation_id']},
+        {'$setOnInsert': doc},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        return False
+    _record_span(doc['document_id'], _span(doc))
+    return True
+
+def update_annotation(document_id, annotation_id, changes):
+    """
+    Apply a partial update to one annotation. Returns the updated annotation, or None if missing.
+    """
+    changes = _clean(changes)
+    if not changes:
+        return None
+    annotation = _collection().find_one_and_update(
+        {'document_id': ObjectId(document_id), 'annotation_id': int(annotation_id)},
+        {'$set': changes},
+        projection={'_id': 0, 'document_id': 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if annotation and 'start' in changes:
+        _record_span(ObjectId(document_id), _span(annotation))
+    return annotation
+
+def delete_annotation(document_id, annotation_id):
+    """
+    Delete one annotation and drop it from the related ids of the others.
+    """
+    document_id = ObjectId(document_id)
+    result = _collection().delete_one({'document_id': document_id, 'annotation_id': int(annotation_id)})
+    if result.deleted_count:
+        _collection().update_many(
+            {'document_id': document_id, 'related_annotation_ids': int(annotation_id)},
+            {'$pull': {'related_annotation_ids': int(annotation_id)}}
+        )
+    return result.deleted_count > 0
+
+def delete_document_annotations(document_ids):
+    """
+    Delete the annotations of one or more documents.
+    """
+    if not isinstance(document_ids, (list, tuple, set)):
+        document_ids = [document_ids]
+    document_ids = [ObjectId(document_id) for document_id in document_ids]
+    _collection().delete_many({'document_id': {'$in': document_ids}})
+    mongo.db.annotation_spans.delete_many({'_id': {'$in': document_ids}})
+
+def get_annotations_in_range(document_id, start, end):
+    """
+    Return the annotations of a document overlapping the character range [start, end),
+    ordered by start. Annotations saved without offsets are not included.
+    """
+    document_id = ObjectId(document_id)
+    spans = mongo.db.annotation_spans.find_one({'_id': document_id}, {'max_span': 1})
+    max_span = spans['max_span'] if spans else 0
+    # An annotation starting more than max_span before the range cannot reach into it
+    return list(_collection().find(
+        {'document_id': document_id, 'start': {'$gte': start - max_span, '$lt': end}, 'end': {'$gt': start}},
+        {'_id': 0, 'document_id': 0}
+    ).sort('start', 1))
+
+def get_page_annotations(document_id, page):
+    """
+    Return the annotations starting on a page, ordered by start.
+    With page=None, return those saved without a page (legacy ones and non-paged documents).
+    """
+    return list(_collection().find(
+        {'document_id': ObjectId(document_id), 'page': int(page) if page is not None else None},
+        {'_id': 0, 'document_id': 0}
+    ).sort([('start', 1), ('annotation_id', 1)]))
+
+def max_annotation_id(document_id):
+    """
+    Return the highest annotation_id of a document, or 0, so new annotations get fresh ids
+    without loading every annotation. Legacy annotations are migrated first.
+    """
+    document_id = ObjectId(document_id)
+    latest = _collection().find_one({'document_id': document_id}, {'annotation_id': 1}, sort=[('annotation_id', -1)])
+    if latest is None and get_annotations(document_id):
+        latest = _collection().find_one({'document_id': document_id}, {'annotation_id': 1}, sort=[('annotation_id', -1)])
+    return latest['annotation_id'] if latest else 0
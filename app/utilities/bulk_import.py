@@ -0,0 +1,295 @@
+import os
+import time
+import socket
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import ReturnDocument
+from .. import mongo
+from datetime import datetime, timedelta
+from . import file_storage, conversion, staging
+
+# Bulk imports read a zip or tar archive entry by entry. Each supported entry becomes a
+# project; PDFs are converted on IMPORT_WORKERS threads and their HTML added as a second
+# version. At most twice as many entries as workers are on local disk at any time, so
+# reading the archive pauses while the workers catch up.
+IMPORT_EXTENSIONS = {'.pdf', '.docx', '.html'}
+IMPORT_WORKERS = 4
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Imports submitted over HTTP keep their archive in the staging bucket and their progress in
+# the imports collection, so any worker can carry on with them. The worker running an import
+# owns it while it renews its lease every IMPORT_LEASE_SECONDS / 3; a resumer thread in every
+# worker takes over imports whose owner was recycled or killed, at most MAX_IMPORT_ATTEMPTS
+# times. A resumed import skips the entries already recorded, and every project remembers
+# the import entry it came from, so an entry cut off halfway is never imported twice.
+IMPORT_LEASE_SECONDS = 60
+MAX_IMPORT_ATTEMPTS = 3
+
+_import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bulk-import')
+_resumer = None
+_resumer_lock = threading.Lock()
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def iter_archive_entries(path):
+    """
+    Yield (name, stream) for every regular file in a zip or tar archive (compressed tars included).
+    Each stream must be consumed before the next entry is requested.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as stream:
+                        yield info.filename, stream
+    elif tarfile.is_tarfile(path):
+        # Stream mode reads the archive strictly front to back, without an index
+        with tarfile.open(path, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+    else:
+        raise ArchiveError("Not a zip or tar archive")
+
+def _is_importable(name):
+    base = os.path.basename(name)
+    if not base or base.startswith('.') or '__MACOSX/' in name:
+        return False
+    return os.path.splitext(base)[-1].lower() in IMPORT_EXTENSIONS
+
+def _import_entry(name, path, convert_pdfs, import_source=None):
+    """
+    Create the project for one archive entry and convert it if it is a PDF.
+    With import_source, a project an interrupted run already created for the entry is reused.
+    Returns the entry's status record.
+    """
+    filename = os.path.basename(name)
+    project_name, ext = os.path.splitext(filename)
+    result = {'entry': name, 'status': 'imported'}
+    try:
+        project = mongo.db.projects.find_one({'import_source': import_source}, {'_id': 1}) if import_source else None
+        if project:
+            project_id = project['_id']
+        else:
+            with open(path, 'rb') as f:
+                project_id = file_storage.create_project(project_name, f, filename, import_source=import_source)
+        result['project_id'] = str(project_id)
+        if project and file_storage.count_project_versions(project_id) > 1:
+            result['status'] = 'converted'
+        elif convert_pdfs and ext.lower() == '.pdf':
+            html_content = conversion.convert_pdf_cached(path)
+            file_storage.update_version(project_id, project_name + '.html', html_content, [])
+            result['status'] = 'converted'
+    except Exception as e:
+        print(f"Import of {name} failed: {e}")
+        # A project whose PDF could not be converted is kept, like after a failed conversion job
+        result.update(status='conversion_failed' if 'project_id' in result else 'failed', error=str(e))
+    finally:
+        os.remove(path)
+    return result
+
+def import_archive(path, convert_pdfs=True, workers=IMPORT_WORKERS, on_result=None, import_id=None, skip=(), stop=None):
+    """
+    Import every PDF, DOCX and HTML file of an archive as a project.
+    on_result is called with each entry's status record as soon as it is known.
+    import_id tags the projects with their entry, entries whose index is in skip are passed
+    over, and reading stops early once the stop event is set.
+    Returns the status records in archive order.
+    """
+    workers = max(workers, 1)
+    pending = threading.BoundedSemaphore(workers * 2)
+    futures = []
+
+    def report(result):
+        if on_result:
+            on_result(result)
+        return result
+
+    def run(name, index, entry_path, import_source):
+        try:
+            return report(dict(_import_entry(name, entry_path, convert_pdfs, import_source), index=index))
+        finally:
+            pending.release()
+
+    with tempfile.TemporaryDirectory(prefix='import-') as work_dir, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import') as executor:
+        for index, (name, stream) in enumerate(iter_archive_entries(path)):
+            if stop is not None and stop.is_set():
+                break
+            if index in skip:
+                continue
+            if not _is_importable(name):
+                futures.append(report({'entry': name, 'index': index, 'status': 'skipped'}))
+                continue
+            # Only this entry is written to disk; pdftohtml and the hashing in save_file need a file
+            pending.acquire()
+            entry_path = os.path.join(work_dir, f'{index}{os.path.splitext(name)[-1].lower()}')
+            try:
+                with open(entry_path, 'wb') as f:
+                    shutil.copyfileobj(stream, f, COPY_BLOCK_SIZE)
+            except Exception:
+                pending.release()
+                raise
+            import_source = {'import_id': import_id, 'entry': index} if import_id else None
+            futures.append(executor.submit(run, name, index, entry_path, import_source))
+
+    return [future if isinstance(future, dict) else future.result() for future in futures]
+
+
+# ---------- IMPORT JOBS ----------
+def _owner():
+    # Computed per call, forked workers must each own their imports under their own pid
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=IMPORT_LEASE_SECONDS)
+
+def _renew(import_id, archive_id):
+    """
+    Extend this process's lease on an import. Returns False if another process has taken it over.
+    """
+    result = mongo.db.imports.update_one({'_id': import_id, 'owner': _owner()}, {'$set': {'lease_expires': _lease()}})
+    # The staged archive must outlive the staging TTL for as long as the import runs
+    mongo.db[f'{staging.STAGING_BUCKET}.files'].update_one({'_id': archive_id}, {'$set': {'uploadDate': datetime.utcnow()}})
+    return result.matched_count > 0
+
+def _run_import(import_id):
+    owner = _owner()
+    job = mongo.db.imports.find_one({'_id': import_id, 'owner': owner})
+    if not job:
+        return
+    finished, lost = threading.Event(), threading.Event()
+
+    def heartbeat():
+        while not finished.wait(IMPORT_LEASE_SECONDS / 3):
+            if not _renew(import_id, job['archive_id']):
+                lost.set()
+                return
+
+    def record(result):
+        mongo.db.imports.update_one(
+            {'_id': import_id, 'owner': owner},
+            {'$push': {'entries': result}, '$inc': {f'counts.{result["status"]}': 1}}
+        )
+
+    threading.Thread(target=heartbeat, name='bulk-import-lease', daemon=True).start()
+    try:
+        mongo.db.imports.update_one({'_id': import_id, 'owner': owner}, {'$set': {'status': 'running'}})
+        with tempfile.TemporaryDirectory(prefix='import-archive-') as work_dir:
+            path = os.path.join(work_dir, 'archive')
+            if not staging.download_staged_file(job['archive_id'], path):
+                raise ArchiveError("The uploaded archive has expired")
+            done = {entry['index'] for entry in job.get('entries', []) if 'index' in entry}
+            import_archive(path, on_result=record, import_id=import_id, skip=done, stop=lost)
+        status = {'status': 'done'}
+    except Exception as e:
+        print(f"Bulk import {import_id} failed: {e}")
+        status = {'status': 'failed', 'error': str(e)}
+    finally:
+        finished.set()
+    if lost.is_set():
+        return
+    result = mongo.db.imports.update_one(
+        {'_id': import_id, 'owner': owner},
+        {'$set': dict(status, finished_at=datetime.utcnow()), '$unset': {'lease_expires': ''}}
+    )
+    if result.matched_count:
+        staging.discard_staged_file(job['archive_id'])
+
+def _is_archive(stream):
+    if not stream.seekable():
+        # Checked when the import runs instead
+        return True
+    valid = zipfile.is_zipfile(stream)
+    stream.seek(0)
+    if not valid:
+        valid = tarfile.is_tarfile(stream)
+        stream.seek(0)
+    return valid
+
+def submit_import(filename, stream=None, staged_id=None):
+    """
+    Import an archive in the background, either uploaded as a stream or already staged
+    through a resumable upload. Returns the import id.
+    Raises ArchiveError if the stream is not an archive or the staged file does not exist.
+    """
+    start_resumer()
+    if stream is not None:
+        if not _is_archive(stream):
+            raise ArchiveError("Not a zip or tar archive")
+        archive_id = staging.stage_upload(stream, filename)
+    else:
+        staged = staging.get_staged_file(staged_id)
+        if staged is None:
+            raise ArchiveError("Staged archive not found")
+        archive_id = staged._id
+
+    import_id = ObjectId()
+    mongo.db.imports.insert_one({
+        '_id': import_id,
+        'filename': filename,
+        'archive_id': archive_id,
+        'status': 'queued',
+        'counts': {},
+        'entries': [],
+        'owner': _owner(),
+        'lease_expires': _lease(),
+        'attempts': 1,
+        'started_at': datetime.utcnow()
+    })
+    _import_executor.submit(_run_import, import_id)
+    return import_id
+
+def resume_abandoned_imports():
+    """
+    Take over queued and running imports whose owner stopped renewing their lease.
+    Imports already attempted MAX_IMPORT_ATTEMPTS times are failed instead.
+    """
+    now = datetime.utcnow()
+    abandoned = {'status': {'$in': ['queued', 'running']}, 'lease_expires': {'$lte': now}}
+    mongo.db.imports.update_many(
+        dict(abandoned, attempts={'$gte': MAX_IMPORT_ATTEMPTS}),
+        {'$set': {'status': 'failed', 'error': 'The import was interrupted too many times', 'finished_at': now}}
+    )
+    while True:
+        job = mongo.db.imports.find_one_and_update(
+            dict(abandoned, attempts={'$lt': MAX_IMPORT_ATTEMPTS}),
+            {'$set': {'status': 'queued', 'owner': _owner(), 'lease_expires': _lease()}, '$inc': {'attempts': 1}},
+            projection={'_id': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            break
+        _import_executor.submit(_run_import, job['_id'])
+
+def _run_resumer():
+    while True:
+        try:
+            resume_abandoned_imports()
+        except Exception as e:
+            print(f"Resuming bulk imports failed: {e}")
+        time.sleep(IMPORT_LEASE_SECONDS)
+
+def start_resumer():
+    """
+    Start the thread of this process that takes over abandoned imports, if it is not running yet.
+    """
+    global _resumer
+    with _resumer_lock:
+        if _resumer is None or not _resumer.is_alive():
+            _resumer = threading.Thread(target=_run_resumer, name='bulk-import-resumer', daemon=True)
+            _resumer.start()
+
+def get_import(import_id):
+    if not ObjectId.is_valid(import_id):
+        return None
+    start_resumer()
+    return mongo.db.imports.find_one({'_id': ObjectId(import_id)})
@@ -0,0 +1,489 @@
+import os
+import re
+import time
+import socket
+import shutil
+import mimetypes
+import hashlib
+import tempfile
+import threading
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import ReturnDocument
+from .. import mongo
+from datetime import datetime, timedelta
+from . import file_storage, staging, scratch
+
+PDFTOHTML_FLAGS = ["-s", "-noframes"]
+# Bump whenever the post-processing of pdftohtml output changes, so cached conversions are redone
+CONVERSION_FORMAT = 2
+
+# Extracted images are stored as assets and referenced by URL instead of inlined as base64
+ASSET_URL = '/assets/{}'
+IMAGE_SRC_PATTERN = re.compile(r'src="([^"]+)"')
+
+# pdftohtml runs as a subprocess, so a small thread pool is enough to keep conversions
+# off the request threads. At most MAX_PENDING_JOBS jobs and page conversions may be queued
+# or running per worker process; further ones are refused so a burst cannot starve
+# interactive routes.
+CONVERSION_WORKERS = 2
+MAX_PENDING_JOBS = 8
+# A job belongs to the process running it for as long as that process renews its lease.
+# A keeper thread per process renews the leases of its jobs every JOB_HEARTBEAT_SECONDS
+# and takes over jobs whose owner was recycled or killed, up to MAX_JOB_ATTEMPTS runs
+# per job so a PDF that crashes its worker ends up failed.
+JOB_LEASE_SECONDS = 60
+JOB_HEARTBEAT_SECONDS = 15
+MAX_JOB_ATTEMPTS = 3
+# A finished job points at its conversion cache entry; jobs expire through a TTL index (see indexes.py)
+CONVERSION_TTL_SECONDS = 24 * 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=CONVERSION_WORKERS, thread_name_prefix='conversion')
+_admission = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+_keeper = None
+_keeper_lock = threading.Lock()
+
+
+# Converted HTML is cached per (source SHA-256, converter version, flags). Entries unused
+# for CACHE_MAX_AGE_DAYS are evicted, then the least recently used until the cache fits in
+# CACHE_MAX_BYTES of uncompressed HTML.
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_MAX_AGE_DAYS = 30
+
+# Paged mode converts single pages on demand and caches each page as its own fragment.
+# The source PDF is kept in a local copy between page requests, bounded by the scratch janitor.
+MAX_PAGES_PER_REQUEST = 10
+BODY_PATTERN = re.compile(r'<body[^>]*>(.*)</body>', re.S | re.I)
+STYLE_PATTERN = re.compile(r'<style[^>]*>.*?</style>', re.S | re.I)
+
+
+class ConversionError(Exception):
+    pass
+
+class ConversionBusy(ConversionError):
+    pass
+
+
+# ---------- CONVERSION ----------
+def convert_pdf_to_html(pdf_path, progress=None, first_page=None, last_page=None):
+    """
+    Convert a PDF to a single HTML document whose images point at stored assets.
+    progress, if given, is called with a percentage as the conversion advances.
+    first_page and last_page restrict the conversion to a page range.
+    Raises ConversionError on failure.
+    """
+    page_flags = []
+    if first_page:
+        page_flags += ["-f", str(first_page)]
+    if last_page:
+        page_flags += ["-l", str(last_page)]
+
+    report = progress or (lambda percent: None)
+    # Each conversion gets its own directory so concurrent jobs never share output files
+    with tempfile.TemporaryDirectory(prefix='pdftohtml-') as work_dir:
+        html_path = os.path.join(work_dir, 'converted.html')
+        try:
+            subprocess.run(["pdftohtml", *PDFTOHTML_FLAGS, *page_flags, pdf_path, html_path], check=True)
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise ConversionError(f"Conversion failed: {e}")
+        report(50)
+
+        try:
+            with open(html_path, 'r', encoding='utf-8') as f:
+                html_content = f.read()
+        except Exception as e:
+            raise ConversionError(f"Failed to read HTML file: {e}")
+
+        image_count = max(len(IMAGE_SRC_PATTERN.findall(html_content)), 1)
+        seen = [0]
+
+        def store_image(match):
+            # Rewrites every reference in a single pass over the document
+            seen[0] += 1
+            report(50 + 40 * seen[0] // image_count)
+            img_path = os.path.realpath(os.path.join(work_dir, match.group(1)))
+            if not img_path.startswith(os.path.realpath(work_dir) + os.sep) or not os.path.isfile(img_path):
+                return match.group(0)
+            with open(img_path, "rb") as img_file:
+                content_type = mimetypes.guess_type(img_path)[0] or 'image/png'
+                asset_id = file_storage.store_asset(img_file.read(), content_type)
+            return f'src="{ASSET_URL.format(asset_id)}"'
+
+        html_content = IMAGE_SRC_PATTERN.sub(store_image, html_content)
+
+    return html_content
+
+
+# ---------- CONVERSION CACHE ----------
+@functools.lru_cache(maxsize=1)
+def converter_version():
+    try:
+        result = subprocess.run(["pdftohtml", "-v"], capture_output=True, text=True)
+    except OSError:
+        return 'unknown'
+    output = (result.stdout + result.stderr).strip()
+    return output.splitlines()[0] if output else 'unknown'
+
+def conversion_cache_key(pdf_path):
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(file_storage.HASH_READ_SIZE), b''):
+            digest.update(block)
+    key = f"{digest.hexdigest()}|{converter_version()}|{' '.join(PDFTOHTML_FLAGS)}|{CONVERSION_FORMAT}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def open_cached_conversion(key):
+    """
+    Open the gzip-compressed blob of a cache entry, marking it as used. Returns None if it is missing.
+    """
+    entry = mongo.db.conversion_cache.find_one_and_update({'_id': key}, {'$set': {'last_used': datetime.utcnow()}})
+    return file_storage.open_blob(entry['blob_id']) if entry else None
+
+def cache_conversion(pdf_path, progress=None):
+    """
+    Make sure the conversion of a PDF is in the conversion cache.
+    Returns the cache key and, if the PDF had to be converted, the HTML (None on a cache hit).
+    """
+    key = conversion_cache_key(pdf_path)
+    blob = open_cached_conversion(key)
+    if blob is not None:
+        blob.close()
+        return key, None
+    _cache_drop({'_id': key})
+
+    html_content = convert_pdf_to_html(pdf_path, progress)
+    _cache_store(key, html_content)
+    evict_conversion_cache()
+    return key, html_content
+
+def convert_pdf_cached(pdf_path, progress=None):
+    """
+    convert_pdf_to_html() backed by the conversion cache.
+    """
+    key, html_content = cache_conversion(pdf_path, progress)
+    if html_content is None:
+        blob = open_cached_conversion(key)
+        if blob is not None:
+            return file_storage.decode_blob(blob).read().decode('utf-8')
+        # Evicted in the meantime
+        html_content = convert_pdf_to_html(pdf_path, progress)
+    return html_content
+
+def _cache_store(key, html_content):
+    blob_id, _, size = file_storage.acquire_blob(html_content, compress=True)
+    # The entry holds the images of the conversion until it is evicted
+    asset_ids = file_storage.referenced_assets(html_content)
+    file_storage.acquire_assets(asset_ids)
+    now = datetime.utcnow()
+    result = mongo.db.conversion_cache.update_one(
+        {'_id': key},
+        {'$setOnInsert': {'blob_id': blob_id, 'asset_ids': asset_ids, 'size': size, 'created_at': now, 'last_used': now}},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        # A concurrent conversion cached the same content first
+        file_storage.release_blob(blob_id)
+        file_storage.release_assets(asset_ids)
+
+def _cache_drop(query):
+    """
+    Delete one cache entry and release its blob and assets. Returns True if it was deleted here.
+    """
+    entry = mongo.db.conversion_cache.find_one_and_delete(query, projection={'blob_id': 1, 'asset_ids': 1})
+    if not entry:
+        return False
+    file_storage.release_blob(entry['blob_id'])
+    file_storage.release_assets(entry.get('asset_ids', []))
+    return True
+
+def evict_conversion_cache():
+    """
+    Drop cache entries past CACHE_MAX_AGE_DAYS, then the least recently used ones
+    until the cache is within CACHE_MAX_BYTES.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=CACHE_MAX_AGE_DAYS)
+    evicted = list(mongo.db.conversion_cache.find({'last_used': {'$lt': cutoff}}, {'_id': 1}))
+
+    totals = list(mongo.db.conversion_cache.aggregate([
+        {'$match': {'last_used': {'$gte': cutoff}}},
+        {'$group': {'_id': None, 'size': {'$sum': '$size'}}}
+    ]))
+    excess = (totals[0]['size'] if totals else 0) - CACHE_MAX_BYTES
+    if excess > 0:
+        for entry in mongo.db.conversion_cache.find({'last_used': {'$gte': cutoff}}, {'size': 1}).sort('last_used', 1):
+            if excess <= 0:
+                break
+            evicted.append(entry)
+            excess -= entry['size']
+
+    for entry in evicted:
+        _cache_drop({'_id': entry['_id']})
+    file_storage.purge_unreferenced_assets()
+
+
+# ---------- PAGED CONVERSION ----------
+def count_pdf_pages(pdf_path):
+    try:
+        result = subprocess.run(["pdfinfo", pdf_path], capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise ConversionError(f"Could not read PDF info: {e}")
+    match = re.search(r'^Pages:\s+(\d+)', result.stdout, re.M)
+    if not match:
+        raise ConversionError("Could not determine the page count")
+    return int(match.group(1))
+
+def local_source(file_id):
+    """
+    Return a local copy of a stored PDF, downloading it once for all page requests.
+    """
+    scratch.start_janitor()
+    os.makedirs(scratch.SHARED_SOURCE_DIR, exist_ok=True)
+    path = os.path.join(scratch.SHARED_SOURCE_DIR, f"{file_id}.pdf")
+    try:
+        # Mark the copy as recently used so the janitor evicts idle documents first
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    # Thread ids repeat across forked workers, so the partial copy gets a name unique to this host
+    fd, partial = tempfile.mkstemp(dir=scratch.SHARED_SOURCE_DIR, prefix=f"{file_id}.", suffix='.part')
+    os.close(fd)
+    try:
+        if not _fetch_source({'kind': 'file', 'id': file_id}, partial):
+            raise ConversionError("Document not found")
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
+
+def page_fragment(html_content, page):
+    # Keep the page's styles with its body so each fragment renders on its own
+    body = BODY_PATTERN.search(html_content)
+    styles = ''.join(STYLE_PATTERN.findall(html_content))
+    inner = body.group(1) if body else html_content
+    return f'<div class="pdf-page" data-page="{page}">{styles}{inner}</div>'
+
+def get_pdf_pages(file_id, start, count):
+    """
+    Return (page_count, [(page, html_fragment), ...]) for up to count pages from start,
+    converting and caching only the pages that are not cached yet.
+    Raises ConversionError if the document is missing or cannot be converted.
+    """
+    file_doc = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)}, {'metadata': 1})
+    if not file_doc:
+        raise ConversionError("Document not found")
+    metadata = file_doc.get('metadata') or {}
+
+    page_count = metadata.get('page_count')
+    if page_count is None:
+        page_count = count_pdf_pages(local_source(file_id))
+        mongo.db.fs.files.update_one({'_id': file_doc['_id']}, {'$set': {'metadata.page_count': page_count}})
+
+    pages = list(range(start, min(start + count, page_count + 1)))
+    source_key = metadata.get('sha256') or str(file_doc['_id'])
+    prefix = f"{source_key}|{converter_version()}|{' '.join(PDFTOHTML_FLAGS)}|{CONVERSION_FORMAT}|page:"
+    keys = {page: hashlib.sha256(f"{prefix}{page}".encode()).hexdigest() for page in pages}
+
+    cached = {}
+    for entry in mongo.db.conversion_cache.find({'_id': {'$in': list(keys.values())}}):
+        content = file_storage.read_blob(entry['blob_id'])
+        if content is not None:
+            cached[entry['_id']] = content.decode('utf-8')
+    if cached:
+        mongo.db.conversion_cache.update_many({'_id': {'$in': list(cached)}}, {'$set': {'last_used': datetime.utcnow()}})
+
+    if len(cached) == len(pages):
+        return page_count, [(page, cached[keys[page]]) for page in pages]
+
+    # Converting pages takes one of the slots background jobs use
+    if not _admission.acquire(blocking=False):
+        raise ConversionBusy("Too many conversions are running, try again shortly")
+    try:
+        fragments = []
+        for page in pages:
+            fragment = cached.get(keys[page])
+            if fragment is None:
+                html_content = convert_pdf_to_html(local_source(file_id), first_page=page, last_page=page)
+                fragment = page_fragment(html_content, page)
+                _cache_store(keys[page], fragment)
+            fragments.append((page, fragment))
+    finally:
+        _admission.release()
+    evict_conversion_cache()
+    return page_count, fragments
+
+
+# ---------- JOB QUEUE ----------
+def _owner():
+    # Looked up on every call, a forked worker must not run jobs under its parent's pid
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+def _update_job(job_id, **fields):
+    """
+    Record the state of a job this process owns. Returns False if another process has taken it over.
+    """
+    fields['updated_at'] = datetime.utcnow()
+    result = mongo.db.conversion_jobs.update_one({'_id': job_id, 'owner': _owner()}, {'$set': fields})
+    return result.matched_count > 0
+
+def _fetch_source(source, path):
+    """
+    Write the job's source PDF to a local path. Returns False if it no longer exists.
+    """
+    if source['kind'] == 'staged':
+        return staging.download_staged_file(source['id'], path)
+    if source['kind'] == 'file':
+        file_data = file_storage.get_file_by_id(source['id'])
+        if not file_data:
+            return False
+        with open(path, 'wb') as f:
+            for chunk in file_storage.iter_file_chunks(file_data['file_object']):
+                f.write(chunk)
+        return True
+    if source['kind'] == 'path' and os.path.exists(source['id']):
+        shutil.copyfile(source['id'], path)
+        return True
+    return False
+
+def _run_job(job_id, source, filename):
+    try:
+        if not _update_job(job_id, status='running', progress=5):
+            return
+        with tempfile.TemporaryDirectory(prefix='conversion-') as work_dir:
+            pdf_path = os.path.join(work_dir, 'source.pdf')
+            if not _fetch_source(source, pdf_path):
+                raise ConversionError(f"File {filename} does not exist on the server")
+
+            last_reported = [5]
+            def progress(percent):
+                # Only write to Mongo when progress moved noticeably
+                if percent - last_reported[0] >= 5:
+                    last_reported[0] = percent
+                    _update_job(job_id, progress=percent)
+
+            cache_key, _ = cache_conversion(pdf_path, progress)
+
+        # The result is the cache entry itself, served from its blob by /conversions/<id>/result
+        _update_job(job_id, status='done', progress=100, cache_key=cache_key)
+    except Exception as e:
+        print(f"Conversion job {job_id} failed: {e}")
+        _update_job(job_id, status='failed', error=str(e))
+    finally:
+        _admission.release()
+
+def _dispatch(job):
+    # The caller holds an admission slot for the job, handed over to _run_job
+    try:
+        _executor.submit(_run_job, job['_id'], job['source'], job['filename'])
+    except Exception:
+        _admission.release()
+        raise
+
+def submit_conversion(source, filename):
+    """
+    Queue a PDF conversion. source is {'kind': 'file' | 'staged' | 'path', 'id': <ObjectId or local path>}.
+    Returns the job id, or None when the queue is full.
+    """
+    start_job_keeper()
+    if not _admission.acquire(blocking=False):
+        return None
+    now = datetime.utcnow()
+    job = {
+        '_id': ObjectId(),
+        'filename': filename,
+        'source': source,
+        'status': 'queued',
+        'progress': 0,
+        'owner': _owner(),
+        'lease_expires': _lease(),
+        'attempts': 1,
+        'created_at': now,
+        'updated_at': now
+    }
+    try:
+        mongo.db.conversion_jobs.insert_one(job)
+    except Exception:
+        _admission.release()
+        raise
+    _dispatch(job)
+    return job['_id']
+
+def resume_abandoned_jobs():
+    """
+    Take over queued and running jobs whose owner stopped renewing their lease, as far as this
+    process has admission slots for them. Jobs already attempted MAX_JOB_ATTEMPTS times are failed.
+    """
+    now = datetime.utcnow()
+    abandoned = {'status': {'$in': ['queued', 'running']}, 'lease_expires': {'$lte': now}}
+    mongo.db.conversion_jobs.update_many(
+        dict(abandoned, attempts={'$gte': MAX_JOB_ATTEMPTS}),
+        {'$set': {'status': 'failed', 'error': 'The conversion was interrupted too many times', 'updated_at': now}}
+    )
+    while _admission.acquire(blocking=False):
+        job = mongo.db.conversion_jobs.find_one_and_update(
+            dict(abandoned, attempts={'$lt': MAX_JOB_ATTEMPTS}),
+            {'$set': {'status': 'queued', 'owner': _owner(), 'lease_expires': _lease(), 'updated_at': now},
+             '$inc': {'attempts': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            _admission.release()
+            break
+        _dispatch(job)
+
+def _keep_jobs():
+    while True:
+        try:
+            # Renew the leases of every job queued or running here, then adopt abandoned ones
+            mongo.db.conversion_jobs.update_many(
+                {'owner': _owner(), 'status': {'$in': ['queued', 'running']}},
+                {'$set': {'lease_expires': _lease()}}
+            )
+            resume_abandoned_jobs()
+        except Exception as e:
+            print(f"Conversion job keeper failed: {e}")
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+
+def start_job_keeper():
+    """
+    Start the thread that keeps this process's conversion jobs leased, if it is not running yet.
+    """
+    global _keeper
+    with _keeper_lock:
+        if _keeper is None or not _keeper.is_alive():
+            _keeper = threading.Thread(target=_keep_jobs, name='conversion-keeper', daemon=True)
+            _keeper.start()
+
+def get_conversion_job(job_id):
+    if not ObjectId.is_valid(job_id):
+        return None
+    start_job_keeper()
+    return mongo.db.conversion_jobs.find_one({'_id': ObjectId(job_id)})
+
+def get_conversion_result(job_id):
+    """
+    Open the cached, gzip-compressed HTML of a finished job as a blob, or return None if the
+    job is unknown, unfinished or its cache entry has since been evicted.
+    """
+    job = get_conversion_job(job_id)
+    if not job or job['status'] != 'done':
+        return None
+    return open_cached_conversion(job['cache_key'])
+
+def purge_legacy_results():
+    """
+    Delete the fs.files entries that older versions saved for every background conversion,
+    unless a project has since adopted them as a version, and the results stored in
+    documents after that.
+    """
+    for job in mongo.db.conversion_jobs.find({'result_file_id': {'$exists': True}}, {'result_file_id': 1}):
+        if not mongo.db.project_versions.find_one({'file_id': job['result_file_id']}, {'_id': 1}):
+            file_storage.delete_files([job['result_file_id']])
+        mongo.db.conversion_jobs.update_one({'_id': job['_id']}, {'$unset': {'result_file_id': ''}})
+    mongo.db.conversion_results.drop()
@@ -1,51 +1,384 @@
-from gridfs import GridFS
+import io
+import os
+import re
+import gzip
+import hashlib
+from collections import Counter
+from gridfs import GridOut, DEFAULT_CHUNK_SIZE
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from flask import current_app
 from bson import ObjectId
-from .. import mongo
-from datetime import datetime
+from .. import mongo, config
+from datetime import datetime, timedelta
+from . import annotations as annotation_store, search
+from .storage_backends import GridFSBackend, create_backends, DEFAULT_BACKEND
 
-def save_file(file, filename, annotations=[]):
+# File contents are stored once per SHA-256 in this bucket and reference-counted;
+# each saved file is a chunkless fs.files entry pointing at its blob.
+BLOB_BUCKET = 'blobs'
+HASH_READ_SIZE = 1024 * 1024
+# A store only loses the race for a hash to a concurrent store or release a few times in a row
+MAX_STORE_ATTEMPTS = 5
+
+# Images extracted from converted documents, stored once per SHA-256 under that hash
+# as filename. Assets are immutable and shared by every version that references them.
+# Each HTML holder (an fs.files entry or a conversion cache entry) records the assets its
+# content references in asset_ids and holds one reference to each (metadata.refcount).
+# Unreferenced assets are deleted once they were last stored ASSET_GRACE_SECONDS ago, which
+# leaves a freshly converted document time to be cached or saved. Assets stored before
+# reference counting have no refcount and are kept.
+ASSET_BUCKET = 'assets'
+ASSET_GRACE_SECONDS = 24 * 60 * 60
+ASSET_REF_PATTERN = re.compile(rb'/assets/([0-9a-f]{64})')
+
+# File types stored gzip-compressed; PDF and DOCX are already compressed formats
+COMPRESSED_FILE_TYPES = {'.html', '.json'}
+COMPRESSION_LEVEL = 6
+
+# The bytes of each blob live in the backend recorded in its metadata; new blobs go to
+# config.STORAGE_BACKEND
+_blob_backends = create_backends(BLOB_BUCKET, config.STORAGE_ROOT)
+
+def _backend_for(blob_doc):
+    return _blob_backends[(blob_doc.get('metadata') or {}).get('backend', DEFAULT_BACKEND)]
+
+class InMemoryFile(io.BytesIO):
     """
-    Save a file to GridFS.
-    Returns the ObjectId of the saved file.
+    In-memory stand-in for a GridOut, used for content that had to be rebuilt or decompressed.
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    @property
+    def length(self):
+        return len(self.getbuffer())
+
+def should_compress(filename):
+    return os.path.splitext(filename or '')[-1].lower() in COMPRESSED_FILE_TYPES
+
+def _hash_payload(file):
+    """
+    Return the SHA-256 of a str, bytes or file-like payload and the payload rewound for storing.
     """
-    fs = GridFS(mongo.db)
     if isinstance(file, str):
         file = file.encode('utf-8')
+    if isinstance(file, bytes):
+        return hashlib.sha256(file).hexdigest(), file
+
+    if not hasattr(file, 'seek'):
+        file = file.read()
+        return hashlib.sha256(file).hexdigest(), file
+
+    digest = hashlib.sha256()
+    start = file.tell()
+    for block in iter(lambda: file.read(HASH_READ_SIZE), b''):
+        digest.update(block)
+    file.seek(start)
+    return digest.hexdigest(), file
+
+def acquire_blob(file, compress=False):
+    """
+    Store a payload in the blob bucket, reusing the existing blob when its hash is already known.
+    With compress=True new blobs are stored gzip-compressed and flagged with metadata.encoding.
+    Returns the blob document's ObjectId, the sha256 and length of the uncompressed content.
+    """
+    sha256, payload = _hash_payload(file)
+    backend = _blob_backends[config.STORAGE_BACKEND]
+    for _ in range(MAX_STORE_ATTEMPTS):
+        blob = acquire_stored_blob(sha256)
+        if blob:
+            return blob[0], sha256, blob[1]
+
+        metadata = {'sha256': sha256, 'refcount': 1, 'backend': backend.name}
+        stored = payload
+        if compress:
+            raw = payload if isinstance(payload, bytes) else payload.read()
+            stored = gzip.compress(raw, compresslevel=COMPRESSION_LEVEL, mtime=0)
+            metadata.update({'encoding': 'gzip', 'content_length': len(raw)})
 
-    file_id = fs.put(file, filename=filename, metadata={'annotations': annotations})
-    return file_id
+        blob_id = ObjectId()
+        try:
+            length = backend.put(blob_id, sha256, stored, metadata)
+        except DuplicateKeyError:
+            # The hash is taken, either by a concurrent store (reused on the next attempt)
+            # or by a blob left unreferenced by an interrupted release_blob, taken over here.
+            # release_blob only deletes blobs still at refcount <= 0, and removes the document
+            # before the bytes, so a blob found here still has all of its data.
+            blob = acquire_stored_blob(sha256, takeover=True)
+            if blob:
+                return blob[0], sha256, blob[1]
+            if not isinstance(payload, bytes):
+                payload.seek(0)
+            continue
+        return blob_id, sha256, metadata.get('content_length', length)
+    raise RuntimeError(f"Could not store blob {sha256} after {MAX_STORE_ATTEMPTS} attempts")
+
+def acquire_stored_blob(sha256, takeover=False):
+    """
+    Take a reference to the stored blob with this SHA-256. With takeover=True, only a blob left
+    unreferenced by an interrupted release_blob is taken over.
+    Returns the blob's ObjectId and the length of its uncompressed content, or None.
+    """
+    blob = mongo.db[f'{BLOB_BUCKET}.files'].find_one_and_update(
+        {'metadata.sha256': sha256, 'metadata.refcount': {'$lte': 0} if takeover else {'$gt': 0}},
+        {'$set': {'metadata.refcount': 1}} if takeover else {'$inc': {'metadata.refcount': 1}},
+        projection={'length': 1, 'metadata.content_length': 1}
+    )
+    return (blob['_id'], blob['metadata'].get('content_length', blob['length'])) if blob else None
+
+def release_blob(blob_id, count=1):
+    """
+    Drop count references to a blob and delete its data once nothing references it.
+    """
+    blob = mongo.db[f'{BLOB_BUCKET}.files'].find_one_and_update(
+        {'_id': blob_id},
+        {'$inc': {'metadata.refcount': -count}},
+        projection={'filename': 1, 'metadata.refcount': 1, 'metadata.backend': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob and blob['metadata']['refcount'] <= 0:
+        removed = mongo.db[f'{BLOB_BUCKET}.files'].delete_one({'_id': blob_id, 'metadata.refcount': {'$lte': 0}})
+        if removed.deleted_count:
+            _backend_for(blob).delete(blob)
+
+def clear_blobs():
+    """
+    Delete every blob, including bytes kept outside MongoDB.
+    """
+    for blob in mongo.db[f'{BLOB_BUCKET}.files'].find({'metadata.backend': {'$nin': [None, DEFAULT_BACKEND]}},
+                                                     {'filename': 1, 'metadata.backend': 1}):
+        _backend_for(blob).delete(blob)
+    mongo.db[f'{BLOB_BUCKET}.files'].delete_many({})
+    mongo.db[f'{BLOB_BUCKET}.chunks'].delete_many({})
+
+def open_blob(blob_id):
+    """
+    Return the stored (possibly compressed) blob as a GridOut, or a LocalBlob for the
+    local backend, or None if it is missing.
+    """
+    blob_doc = mongo.db[f'{BLOB_BUCKET}.files'].find_one({'_id': blob_id})
+    if not blob_doc:
+        return None
+    try:
+        return _backend_for(blob_doc).open(blob_doc)
+    except FileNotFoundError:
+        return None
+
+def blob_encoding(blob):
+    return (blob.metadata or {}).get('encoding')
+
+def decode_blob(blob):
+    """
+    Return the uncompressed content of an opened blob as a file-like object.
+    """
+    if blob_encoding(blob) == 'gzip':
+        return InMemoryFile(gzip.decompress(blob.read()))
+    return blob
+
+def read_blob(blob_id):
+    blob = open_blob(blob_id)
+    return decode_blob(blob).read() if blob else None
+
+_asset_store = GridFSBackend(ASSET_BUCKET)
+
+def _asset_bucket():
+    return _asset_store.bucket()
+
+def store_asset(data, content_type):
+    """
+    Store an immutable asset such as an extracted image. Returns its SHA-256, which is also its id.
+    The asset starts unreferenced; the holder of the HTML that uses it acquires it.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    now = datetime.utcnow()
+    # Storing an existing asset again restarts its grace period
+    if mongo.db[f'{ASSET_BUCKET}.files'].find_one_and_update({'filename': sha256}, {'$set': {'metadata.stored_at': now}},
+                                                           projection={'_id': 1}):
+        return sha256
+    try:
+        _asset_store.put(ObjectId(), sha256, data, {'content_type': content_type, 'refcount': 0, 'stored_at': now})
+    except DuplicateKeyError:
+        # Another request stored the same asset first; put() removed our chunks
+        pass
+    return sha256
+
+def referenced_assets(content):
+    """
+    Return the sorted ids of the assets an HTML document (str or bytes) references.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return sorted({match.decode('ascii') for match in ASSET_REF_PATTERN.findall(content)})
+
+def acquire_assets(asset_ids):
+    """
+    Take one reference to each asset, for a new holder of HTML using them.
+    """
+    if asset_ids:
+        mongo.db[f'{ASSET_BUCKET}.files'].update_many(
+            {'filename': {'$in': list(asset_ids)}, 'metadata.refcount': {'$exists': True}},
+            {'$inc': {'metadata.refcount': 1}}
+        )
+
+def release_assets(asset_refs):
+    """
+    Drop references to assets, given as an iterable of ids (one reference each) or a Counter,
+    then delete the assets nothing references any more.
+    """
+    counts = asset_refs if isinstance(asset_refs, Counter) else Counter(asset_refs)
+    by_count = {}
+    for asset_id, count in counts.items():
+        by_count.setdefault(count, []).append(asset_id)
+    for count, asset_ids in by_count.items():
+        mongo.db[f'{ASSET_BUCKET}.files'].update_many(
+            {'filename': {'$in': asset_ids}, 'metadata.refcount': {'$exists': True}},
+            {'$inc': {'metadata.refcount': -count}}
+        )
+    if counts:
+        purge_unreferenced_assets()
+
+def purge_unreferenced_assets():
+    """
+    Delete assets without references whose grace period is over. Returns the number deleted.
+    """
+    unreferenced = {'metadata.refcount': {'$lte': 0},
+                    'metadata.stored_at': {'$lt': datetime.utcnow() - timedelta(seconds=ASSET_GRACE_SECONDS)}}
+    deleted = 0
+    for asset in mongo.db[f'{ASSET_BUCKET}.files'].find(unreferenced, {'_id': 1}):
+        # Re-checked on delete, an asset acquired or stored again in the meantime is kept
+        if mongo.db[f'{ASSET_BUCKET}.files'].delete_one(dict(unreferenced, _id=asset['_id'])).deleted_count:
+            _asset_store.delete(asset)
+            deleted += 1
+    return deleted
+
+def open_asset(sha256):
+    try:
+        return _asset_bucket().open_download_stream_by_name(sha256)
+    except NoFile:
+        return None
+
+def save_file(file, filename, annotations=[], unique_name=False):
+    """
+    Save a file to GridFS.
+    Identical contents share a single blob; the fs.files entry only records the reference.
+    HTML and JSON files are stored compressed.
+    With unique_name=True the filename is claimed through the unique filename index and
+    DuplicateKeyError is raised if another named file already holds it.
+    Returns the ObjectId of the saved file.
+    """
+    asset_ids = []
+    if (filename or '').lower().endswith('.html'):
+        # HTML is small enough to scan for the assets it keeps alive
+        file = file.encode('utf-8') if isinstance(file, str) else file if isinstance(file, bytes) else file.read()
+        asset_ids = referenced_assets(file)
+    blob_id, sha256, length = acquire_blob(file, compress=should_compress(filename))
+    return add_file_entry(filename, blob_id, sha256, length, annotations, unique_name, asset_ids)
+
+def add_file_entry(filename, blob_id, sha256, length, annotations=[], unique_name=False, asset_ids=(), file_id=None):
+    """
+    Create the chunkless fs.files entry of a file whose content is already in the blob bucket,
+    taking over the caller's reference to the blob. The reference is dropped again if
+    unique_name=True and the name is taken, which raises DuplicateKeyError.
+    Returns the ObjectId of the file.
+    """
+    metadata = {
+        'blob_id': blob_id,
+        'sha256': sha256,
+        'content_length': length
+    }
+    if unique_name:
+        metadata['unique_name'] = True
+    if asset_ids:
+        metadata['asset_ids'] = list(asset_ids)
+    acquire_assets(asset_ids)
+    file_doc = {
+        'filename': filename,
+        'length': 0,
+        'chunkSize': DEFAULT_CHUNK_SIZE,
+        'uploadDate': datetime.utcnow(),
+        'metadata': metadata
+    }
+    if file_id is not None:
+        file_doc['_id'] = file_id
+    try:
+        result = mongo.db.fs.files.insert_one(file_doc)
+    except DuplicateKeyError:
+        release_blob(blob_id)
+        release_assets(asset_ids)
+        raise
+    if annotations:
+        annotation_store.set_annotations(result.inserted_id, annotations)
+    return result.inserted_id
+
+def get_file_info(file_id):
+    """
+    Return the id and filename of a stored file without touching its content,
+    or None if it does not exist.
+    """
+    if not ObjectId.is_valid(file_id):
+        return None
+    file_doc = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)}, {'filename': 1})
+    if not file_doc:
+        return None
+    return {'file_id': file_doc['_id'], 'filename': file_doc['filename']}
 
 def get_file_by_filename(filename):
     """
     Retrieve a file from GridFS by its filename.
     Returns the file object.
     """
-    fs = GridFS(mongo.db)
-    return fs.find_one({'filename': filename})
+    file_doc = mongo.db.fs.files.find_one({'filename': filename}, {'_id': 1})
+    if not file_doc:
+        return None
+    file_data = get_file_by_id(file_doc['_id'])
+    return file_data['file_object'] if file_data else None
 
-def get_file_by_id(file_id):
+def get_file_by_id(file_id, accept_encodings=()):
     """
     Retrieve a file from GridFS by its ObjectId.
     Returns the file object along with its filename.
+    Compressed content is returned as stored when its encoding is listed in accept_encodings
+    (reported under 'content_encoding'), and decompressed otherwise.
     """
     try:
-        fs = GridFS(mongo.db)
         if not ObjectId.is_valid(file_id):
             print(f"Invalid ObjectId format: {file_id}")
             return None
 
-        file_obj = fs.find_one({'_id': ObjectId(file_id)})
-        if not file_obj:
+        file_doc = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)})
+        if not file_doc:
             print(f"No file found with ObjectId: {file_id}")
             return None
+        file_obj = GridOut(mongo.db.fs, file_document=file_doc)
+
+        metadata = getattr(file_obj, "metadata", None) or {}
+        annotations = annotation_store.get_annotations(file_obj._id)
 
-        # Note the changes here:
-        metadata = getattr(file_obj, "metadata", {})
-        annotations = metadata.get('annotations', [])
+        # Delta versions are rebuilt from their keyframe, content-addressed
+        # files keep their bytes in the blob bucket
+        content = file_obj
+        content_encoding = None
+        if metadata.get('delta_base'):
+            from .version_store import read_version
+            data = read_version(file_obj._id)
+            if data is None:
+                return None
+            content = InMemoryFile(data)
+        elif metadata.get('blob_id'):
+            content = open_blob(metadata['blob_id'])
+            if content is None:
+                print(f"Missing blob for file with ObjectId: {file_id}")
+                return None
+            if blob_encoding(content) in accept_encodings:
+                content_encoding = blob_encoding(content)
+            else:
+                content = decode_blob(content)
 
         return {
-            'file_object': file_obj,
+            'file_id': file_obj._id,
+            'file_object': content,
+            'content_encoding': content_encoding,
             'filename': file_obj.filename,
             'annotations': annotations
         }
@@ -54,39 +387,126 @@ def get_file_by_id(file_id):
         print(f"Error in get_file_by_id: {str(e)}")
         return None
 
-def delete_file(file_id):
+def file_etag(file_id, accept_encodings=()):
     """
-    Delete a file from GridFS by its ObjectId and also remove its reference from the projects collection.
+    Return the strong ETag get_file_by_id(file_id, accept_encodings) would be served with,
+    or None if the file does not exist. Only file documents are read, never chunks.
+    Stored files never change, so the tag is the content hash (the file id for legacy
+    files), suffixed with the content coding when the compressed bytes are passed through.
     """
-    fs = GridFS(mongo.db)
+    if not ObjectId.is_valid(file_id):
+        return None
+    file_doc = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)}, {'metadata': 1})
+    if not file_doc:
+        return None
 
-    # Search directly in the underlying 'fs.files' collection
-    file_obj = mongo.db.fs.files.find_one({'_id': ObjectId(file_id)})
-    if not file_obj:
-        print(f"File with ID {file_id} not found in GridFS.")
-        return False
+    metadata = file_doc.get('metadata') or {}
+    etag = metadata.get('content_sha256') or metadata.get('sha256') or str(file_doc['_id'])
+    if metadata.get('blob_id') and not metadata.get('delta_base'):
+        blob = mongo.db[f'{BLOB_BUCKET}.files'].find_one({'_id': metadata['blob_id']}, {'metadata.encoding': 1})
+        encoding = ((blob or {}).get('metadata') or {}).get('encoding')
+        if encoding and encoding in accept_encodings:
+            etag += f'-{encoding}'
+    return etag
+
+def iter_file_chunks(file_obj, start=0, end=None):
+    """
+    Yield the bytes of a GridFS file between start and end (exclusive),
+    reading at most one GridFS chunk at a time so memory stays constant.
+    """
+    end = file_obj.length if end is None else end
+    file_obj.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = file_obj.read(min(file_obj.chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+def _remove_stored_files(file_ids):
+    """
+    Delete fs.files entries with their chunks and release the blobs and assets they reference.
+    Only the references of entries this call actually deleted are released, so concurrent
+    deletes of the same files never drop a reference twice. Returns the deleted ids.
+    """
+    file_docs = [file_doc for file_doc in (
+        mongo.db.fs.files.find_one_and_delete({'_id': file_id}, projection={'metadata.blob_id': 1, 'metadata.asset_ids': 1})
+        for file_id in file_ids
+    ) if file_doc]
+    removed_ids = [file_doc['_id'] for file_doc in file_docs]
+    if removed_ids:
+        mongo.db.fs.chunks.delete_many({'files_id': {'$in': removed_ids}})
+
+    blob_refs = Counter((file_doc.get('metadata') or {}).get('blob_id') for file_doc in file_docs)
+    blob_refs.pop(None, None)
+    for blob_id, count in blob_refs.items():
+        release_blob(blob_id, count)
+    release_assets(Counter(asset_id for file_doc in file_docs
+                           for asset_id in (file_doc.get('metadata') or {}).get('asset_ids', [])))
+    return removed_ids
 
+def delete_files(file_ids):
+    """
+    Delete many files in one pass, together with their annotations and version entries.
+    Only the owning projects are touched, found through the indexed project_versions.file_id.
+    Returns the ids of the projects that owned the files, or None if none of the files exist.
+    """
+    from .version_store import detach_dependents
+
+    file_ids = [ObjectId(file_id) for file_id in file_ids if ObjectId.is_valid(file_id)]
+    file_ids = mongo.db.fs.files.distinct('_id', {'_id': {'$in': file_ids}})
+    if not file_ids:
+        return None
+
+    project_ids = _versions().distinct("project_id", {"file_id": {"$in": file_ids}})
+    detach_dependents(file_ids)
+    _remove_stored_files(file_ids)
+    annotation_store.delete_document_annotations(file_ids)
+    search.remove_versions(file_ids)
+    _versions().delete_many({"file_id": {"$in": file_ids}})
+    return project_ids
+
+def delete_file(file_id):
+    """
+    Delete a file from GridFS by its ObjectId and also remove its reference from its project.
+    The underlying blob is only removed once no other file references it.
+    """
     try:
-        fs.delete(ObjectId(file_id)) 
-        mongo.db.projects.update_many({}, {"$pull": {"versions": {"file_id": ObjectId(file_id)}}})
-        
+        if delete_files([file_id]) is None:
+            print(f"File with ID {file_id} not found in GridFS.")
+            return False
         print(f"File with ID {file_id} deleted successfully.")
         return True
     except Exception as e:
         print(f"Error deleting file with ID {file_id}: {e}")
         return False
 
+def purge_project_versions(project_id, batch_size):
+    """
+    Delete up to batch_size versions of a project, files and annotations included,
+    with one bulk delete per collection. Returns the number of versions removed.
+    """
+    versions = list(_versions().find({"project_id": ObjectId(project_id)}, {"file_id": 1}).limit(batch_size))
+    if not versions:
+        return 0
+    file_ids = [version['file_id'] for version in versions]
+    _remove_stored_files(file_ids)
+    annotation_store.delete_document_annotations(file_ids)
+    search.remove_versions(file_ids)
+    _versions().delete_many({"_id": {"$in": [version['_id'] for version in versions]}})
+    return len(versions)
+
+def count_project_versions(project_id):
+    return _versions().count_documents({"project_id": ObjectId(project_id)})
+
 def delete_project(project_id):
     """
     Delete a project from the projects collection and also delete all of its versions from GridFS.
     """
-    fs = GridFS(mongo.db)
-
-    # Delete all versions of the project from GridFS
-    project = mongo.db.projects.find_one({"_id": ObjectId(project_id)})
-    if project:
-        for version in project.get('versions', []):
-            fs.delete(version['file_id'])
+    # Delete all versions of the project from GridFS, releasing their blobs
+    while purge_project_versions(project_id, 500):
+        pass
     
     # Delete the project from the projects collection
     result = mongo.db.projects.delete_one({"_id": ObjectId(project_id)})
@@ -96,64 +516,154 @@ def get_all_documents():
     """
     Return a list of all documents in GridFS.
     """
-    fs = GridFS(mongo.db)
     return [{'filename': doc['filename'], 'uploadDate': doc['uploadDate']} for doc in mongo.db.fs.files.find()]
 
 
 # ---------- PROJECT TABLES ----------
-def create_project(project_name, file, filename):
-    # Save the file to GridFS first
-    file_id = save_file(file, filename)
+# Versions live in their own collection, one document per version, instead of an
+# ever-growing array inside the project document.
+def _versions():
+    return mongo.db.project_versions
+
+def migrate_embedded_versions():
+    """
+    Move versions still embedded in project documents into the project_versions collection.
+    Safe to run repeatedly; projects are only unset once their versions are copied.
+    """
+    for project in mongo.db.projects.find({"versions": {"$exists": True}}, {"versions": 1}):
+        versions = [{"project_id": project["_id"], "file_id": version["file_id"], "version_date": version["version_date"]}
+                    for version in project.get("versions") or []]
+        existing = {version["file_id"] for version in mongo.db.project_versions.find({"project_id": project["_id"]}, {"file_id": 1})}
+        missing = [version for version in versions if version["file_id"] not in existing]
+        if missing:
+            mongo.db.project_versions.insert_many(missing)
+        mongo.db.projects.update_one({"_id": project["_id"]}, {"$unset": {"versions": ""}})
+
+def add_version(project_id, file_id):
+    version_entry = {
+        "project_id": ObjectId(project_id),
+        "file_id": file_id,
+        "version_date": datetime.utcnow()
+    }
+    return _versions().insert_one(version_entry).inserted_id
+
+def create_project(project_name, file, filename, file_id=None, import_source=None):
+    # Save the file to GridFS first, unless it is already stored (e.g. a promoted staged upload)
+    saved_here = file_id is None
+    if saved_here:
+        file_id = save_file(file, filename)
     
-    # Create a new project entry with an initial version
+    # Create a new project entry, then its initial version
     project_entry = {
         "project_name": project_name,
         "File_name": filename,
         "File_type": filename.split('.')[-1],
-        "creation_date": datetime.utcnow(),
-        "versions": [{
-            "file_id": file_id,
-            "version_date": datetime.utcnow()
-        }]
+        "creation_date": datetime.utcnow()
     }
+    if import_source:
+        # The bulk import entry the project came from, unique so a resumed import never repeats it
+        project_entry["import_source"] = import_source
 
-    result = mongo.db.projects.insert_one(project_entry)
+    try:
+        result = mongo.db.projects.insert_one(project_entry)
+    except DuplicateKeyError:
+        if saved_here:
+            _remove_stored_files([file_id])
+        raise
+    add_version(result.inserted_id, file_id)
     return result.inserted_id
 
-def list_all_projects():
-    projects_cursor = mongo.db.projects.find({}, {"project_name": 1})  # Only retrieve the project_name and _id
-    projects = list(projects_cursor)
-    return projects
+def list_all_projects(after=None, limit=50, name_prefix=None):
+    """
+    Return one page of projects ordered by _id, with summaries computed inside MongoDB.
+
+    :param after: The _id of the last project on the previous page.
+    :param limit: The maximum number of projects to return.
+    :param name_prefix: Only return projects whose name starts with this prefix.
+    :return: The projects and the cursor for the next page (None on the last page).
+    """
+    # Projects being deleted in the background are hidden straight away
+    match = {"deleted_at": {"$exists": False}}
+    if after:
+        match["_id"] = {"$gt": ObjectId(after)}
+    if name_prefix:
+        match["project_name"] = {"$regex": "^" + re.escape(name_prefix)}
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$limit": limit},
+        {"$lookup": {"from": "project_versions", "localField": "_id", "foreignField": "project_id", "as": "versions"}},
+        {"$lookup": {"from": "fs.files", "localField": "versions.file_id", "foreignField": "_id", "as": "files"}},
+        {"$project": {
+            "_id": {"$toString": "$_id"},
+            "project_name": 1,
+            "version_count": {"$size": {"$ifNull": ["$versions", []]}},
+            "latest_version_date": {"$max": "$versions.version_date"},
+            "total_bytes": {"$sum": {"$map": {
+                "input": "$files",
+                "in": {"$ifNull": ["$$this.metadata.content_length", "$$this.length"]}
+            }}}
+        }}
+    ]
+    projects = list(mongo.db.projects.aggregate(pipeline))
+    next_cursor = projects[-1]["_id"] if len(projects) == limit else None
+    return projects, next_cursor
+
+def get_project_versions(project_id, after=None, limit=50):
+    """
+    Return one page of a project's versions, oldest first, read in index order from
+    the (project_id, version_date, _id) index.
+
+    :param project_id: The ID of the project.
+    :param after: The _id of the last version on the previous page.
+    :param limit: The maximum number of versions to return.
+    :return: The version documents.
+    """
+    query = {"project_id": ObjectId(project_id)}
+    if after:
+        previous = _versions().find_one({"_id": ObjectId(after)}, {"version_date": 1})
+        if previous:
+            query["$or"] = [
+                {"version_date": {"$gt": previous["version_date"]}},
+                {"version_date": previous["version_date"], "_id": {"$gt": previous["_id"]}}
+            ]
+    return list(_versions().find(query).sort([("version_date", 1), ("_id", 1)]).limit(limit))
 
-def get_project_versions(project_id):
-    project = mongo.db.projects.find_one({"_id": ObjectId(project_id)})
-    if project:
-        return project.get('versions', [])
-    return []
+def get_latest_version(project_id):
+    """
+    Return the newest version of a project, or None, using the (project_id, version_date) index.
+    """
+    return _versions().find_one({"project_id": ObjectId(project_id)}, sort=[("version_date", -1), ("_id", -1)])
 
 def update_version(project_id, filename, updated_html, annotations):
     """
     Adds a new version to a specific project.
+    The HTML is stored as a delta against the project's latest version, with periodic keyframes.
     
     :param project_id: The ID of the project to which the version will be added.
-    :param file: The file object to save in GridFS.
     :param filename: The name of the file to save.
+    :param updated_html: The updated HTML content.
     :param annotations: The annotations of the file.
-    :return: Update result.
+    :return: The ObjectId of the new version's file, or None if the project does not exist.
     """
+    from .version_store import save_version
+
+    if not mongo.db.projects.find_one({"_id": ObjectId(project_id), "deleted_at": {"$exists": False}}, {"_id": 1}):
+        return None
+    latest = get_latest_version(project_id)
+    base_file_id = latest['file_id'] if latest else None
+
     # Save the updated HTML to GridFS
-    file_id = save_file(updated_html, filename, annotations)
+    file_id = save_version(updated_html, filename, annotations, base_file_id)
     
     # Add the new version to the project
-    version_entry = {
-        "file_id": file_id,
-        "version_date": datetime.utcnow()
-    }
-    
-    result = mongo.db.projects.update_one(
-        {"_id": ObjectId(project_id)},
-        {"$push": {"versions": version_entry}}
-    )
+    if add_version(project_id, file_id) is None:
+        return None
 
-    # Check if the update was successful
-    return result.modified_count > 0
\ No newline at end of file
+    # A version that could not be indexed is still saved; search.reindex_all() picks it up later
+    try:
+        search.index_version(project_id, file_id, filename, updated_html, annotations)
+    except Exception as e:
+        print(f"Error indexing version {file_id} for search: {e}")
+    return file_id
\ No newline at end of file
@@ -0,0 +1,126 @@
+import sys
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT
+from .. import mongo
+from .file_storage import BLOB_BUCKET, ASSET_BUCKET
+from .staging import STAGING_BUCKET, STAGING_TTL_SECONDS
+from .sessions import SESSION_COLLECTION
+from .conversion import CONVERSION_TTL_SECONDS
+from .search import SEARCH_COLLECTION, SEARCH_INDEX_NAME, SEARCH_WEIGHTS
+
+# Every index the application relies on, created once at start-up by ensure_indexes().
+# Each entry is (collection, keys, options) as passed to create_index.
+REQUIRED_INDEXES = [
+    # Filename lookups (/save duplicate check, get_file_by_filename)
+    ('fs.files', [('filename', ASCENDING)], {}),
+    # Names chosen in /save are unique; versions written by update_project may share theirs
+    ('fs.files', [('filename', ASCENDING), ('metadata.unique_name', ASCENDING)],
+     {'unique': True, 'partialFilterExpression': {'metadata.unique_name': True}}),
+    # Finding the versions stored as deltas against a file that is being deleted
+    ('fs.files', [('metadata.delta_base', ASCENDING)], {'sparse': True}),
+    (f'{BLOB_BUCKET}.files', [('metadata.sha256', ASCENDING)], {'unique': True}),
+    (f'{ASSET_BUCKET}.files', [('filename', ASCENDING)], {'unique': True}),
+    # Unreferenced assets, deleted by purge_unreferenced_assets() once their grace period is over
+    (f'{ASSET_BUCKET}.files', [('metadata.refcount', ASCENDING), ('metadata.stored_at', ASCENDING)],
+     {'partialFilterExpression': {'metadata.refcount': {'$exists': True}}}),
+    # Backstop for staged uploads that purge_expired_staged_files() missed
+    (f'{STAGING_BUCKET}.files', [('uploadDate', ASCENDING)], {'expireAfterSeconds': STAGING_TTL_SECONDS * 2}),
+    # Resumable uploads write staging chunks directly, before GridFS has created its index
+    (f'{STAGING_BUCKET}.chunks', [('files_id', ASCENDING), ('n', ASCENDING)], {'unique': True}),
+    ('staging_uploads', [('updated_at', ASCENDING)], {}),
+    ('projects', [('project_name', ASCENDING)], {}),
+    # The project of each bulk import entry, looked up when an interrupted import resumes
+    ('projects', [('import_source', ASCENDING)],
+     {'unique': True, 'partialFilterExpression': {'import_source': {'$exists': True}}}),
+    # Imports whose lease ran out, taken over by resume_abandoned_imports()
+    ('imports', [('status', ASCENDING), ('lease_expires', ASCENDING)], {}),
+    # Covers the (version_date, _id) sort of paged version lists and the latest-version lookup
+    ('project_versions', [('project_id', ASCENDING), ('version_date', ASCENDING), ('_id', ASCENDING)], {}),
+    ('project_versions', [('file_id', ASCENDING)], {}),
+    ('annotations', [('document_id', ASCENDING), ('annotation_id', ASCENDING)], {'unique': True}),
+    # Annotations overlapping a range or starting on a page, in text order
+    ('annotations', [('document_id', ASCENDING), ('start', ASCENDING), ('end', ASCENDING)], {}),
+    ('annotations', [('document_id', ASCENDING), ('page', ASCENDING), ('start', ASCENDING)], {}),
+    ('conversion_cache', [('last_used', ASCENDING)], {}),
+    # Background conversion jobs are only needed until the client fetches their result
+    ('conversion_jobs', [('updated_at', ASCENDING)], {'expireAfterSeconds': CONVERSION_TTL_SECONDS}),
+    # Jobs whose lease ran out, taken over by resume_abandoned_jobs(), and the jobs of one process
+    ('conversion_jobs', [('status', ASCENDING), ('lease_expires', ASCENDING)], {}),
+    ('conversion_jobs', [('owner', ASCENDING), ('status', ASCENDING)], {}),
+    # Unfinished deletions whose lease ran out, claimed by resume_pending_deletions()
+    ('project_deletions', [('status', ASCENDING), ('lease_expires', ASCENDING)], {}),
+    # One text index per collection: project name, annotation text and report text, weighted
+    (SEARCH_COLLECTION, [(field, TEXT) for field in SEARCH_WEIGHTS],
+     {'name': SEARCH_INDEX_NAME, 'weights': SEARCH_WEIGHTS, 'default_language': 'english'}),
+    (SEARCH_COLLECTION, [('project_id', ASCENDING)], {}),
+    # Versions whose annotation text is out of date, rebuilt by refresh_annotations()
+    (SEARCH_COLLECTION, [('annotation_edits', ASCENDING)], {'sparse': True}),
+    # Server-side sessions are dropped once they expire
+    (SESSION_COLLECTION, [('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+]
+
+# Representative filters of the hot queries, checked by check_query_plans().
+# Each entry is (name, collection, filter, sort).
+HOT_QUERIES = [
+    ('save duplicate check', 'fs.files', {'filename': 'example.pdf'}, None),
+    ('delta dependents', 'fs.files', {'metadata.delta_base': {'$in': [ObjectId()]}}, None),
+    ('blob by hash', f'{BLOB_BUCKET}.files', {'metadata.sha256': '0' * 64}, None),
+    ('asset by hash', f'{ASSET_BUCKET}.files', {'filename': '0' * 64}, None),
+    ('unreferenced assets', f'{ASSET_BUCKET}.files',
+     {'metadata.refcount': {'$lte': 0}, 'metadata.stored_at': {'$lt': datetime(2000, 1, 1)}}, None),
+    ('staged uploads expiry', f'{STAGING_BUCKET}.files', {'uploadDate': {'$lt': datetime(2000, 1, 1)}}, None),
+    ('abandoned uploads', 'staging_uploads', {'updated_at': {'$lt': datetime(2000, 1, 1)}}, None),
+    ('upload chunk', f'{STAGING_BUCKET}.chunks', {'files_id': ObjectId(), 'n': 0}, None),
+    ('project by id', 'projects', {'_id': ObjectId()}, None),
+    ('projects by name prefix', 'projects', {'project_name': {'$regex': '^example'}}, None),
+    ('project versions', 'project_versions', {'project_id': ObjectId()}, [('version_date', ASCENDING), ('_id', ASCENDING)]),
+    ('file owner', 'project_versions', {'file_id': ObjectId()}, None),
+    ('document annotations', 'annotations', {'document_id': ObjectId()}, [('annotation_id', ASCENDING)]),
+    ('annotations in range', 'annotations',
+     {'document_id': ObjectId(), 'start': {'$gte': 0, '$lt': 5000}, 'end': {'$gt': 1000}}, [('start', ASCENDING)]),
+    ('page annotations', 'annotations', {'document_id': ObjectId(), 'page': 1}, [('start', ASCENDING)]),
+    ('conversion cache expiry', 'conversion_cache', {'last_used': {'$lt': datetime(2000, 1, 1)}}, None),
+    ('expired conversion leases', 'conversion_jobs', {'status': 'queued', 'lease_expires': {'$lte': datetime(2000, 1, 1)}}, None),
+    ('expired deletion leases', 'project_deletions', {'status': 'running', 'lease_expires': {'$lte': datetime(2000, 1, 1)}}, None),
+    ('search entries of a project', SEARCH_COLLECTION, {'project_id': ObjectId()}, None),
+]
+
+def ensure_indexes():
+    """
+    Create every index in REQUIRED_INDEXES. Existing indexes are left untouched.
+    """
+    for collection, keys, options in REQUIRED_INDEXES:
+        mongo.db[collection].create_index(keys, **options)
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+def explain_query(collection, query, sort=None):
+    """
+    Return the stages of the winning plan for a query, outermost first.
+    """
+    cursor = mongo.db[collection].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    planner = cursor.explain().get('queryPlanner', {})
+    return _plan_stages(planner.get('winningPlan', {}))
+
+def check_query_plans():
+    """
+    Explain every query in HOT_QUERIES and return the names of those that scan a whole collection.
+    """
+    return [name for name, collection, query, sort in HOT_QUERIES
+            if 'COLLSCAN' in explain_query(collection, query, sort)]
+
+if __name__ == '__main__':
+    # python -m app.utilities.indexes: create the indexes, then fail if a hot query still scans
+    ensure_indexes()
+    scans = check_query_plans()
+    for name in scans:
+        print(f"Collection scan: {name}")
+    sys.exit(1 if scans else 0)
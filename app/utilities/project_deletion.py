@@ -0,0 +1,171 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument
+from .. import mongo
+from . import file_storage, search
+
+# Projects are tombstoned (deleted_at) right away and purged by a background worker in
+# batches of DELETION_BATCH_SIZE versions, each batch a handful of bulk deletes.
+# Progress is kept in the project_deletions collection, keyed by project id.
+# A process purges a project only while it holds the deletion's lease (owner and
+# lease_expires), renewed after every batch. Deletions whose owner stopped renewing,
+# and failed ones, are claimed again by whichever process resumes them first.
+DELETION_BATCH_SIZE = 200
+LEASE_SECONDS = 60
+RESUME_INTERVAL_SECONDS = LEASE_SECONDS
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='project-deletion')
+_last_resume = 0
+_resume_lock = threading.Lock()
+_resumer = None
+# Deletions queued or running in this process, never submitted twice
+_queued = set()
+
+def _owner():
+    # Computed on every call so forked workers never share their parent's identity
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+
+def _renew(project_id, status=None, deleted=0):
+    """
+    Extend this process's lease, recording progress at the same time.
+    Returns False if another process has taken the deletion over.
+    """
+    update = {'$set': {'lease_expires': _lease()}}
+    if status:
+        update['$set']['status'] = status
+    if deleted:
+        update['$inc'] = {'deleted': deleted}
+    result = mongo.db.project_deletions.update_one({'_id': project_id, 'owner': _owner()}, update)
+    return result.matched_count > 0
+
+def _purge(project_id):
+    try:
+        if not _renew(project_id, status='running'):
+            return
+        while True:
+            removed = file_storage.purge_project_versions(project_id, DELETION_BATCH_SIZE)
+            if not removed:
+                break
+            if not _renew(project_id, deleted=removed):
+                return
+        mongo.db.projects.delete_one({'_id': project_id})
+        mongo.db.project_deletions.update_one(
+            {'_id': project_id, 'owner': _owner()},
+            {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}, '$unset': {'lease_expires': ''}}
+        )
+    except Exception as e:
+        print(f"Error deleting project with ID {project_id}: {e}")
+        # Release the lease so the next resume retries straight away
+        mongo.db.project_deletions.update_one(
+            {'_id': project_id, 'owner': _owner()},
+            {'$set': {'status': 'failed', 'error': str(e), 'lease_expires': datetime.utcnow()}}
+        )
+
+def _submit(project_id):
+    def run():
+        try:
+            _purge(project_id)
+        finally:
+            with _resume_lock:
+                _queued.discard(project_id)
+
+    with _resume_lock:
+        if project_id in _queued:
+            return
+        _queued.add(project_id)
+    _executor.submit(run)
+
+def _claim_expired():
+    """
+    Atomically take over one unfinished deletion whose lease has run out. Returns its id or None.
+    """
+    now = datetime.utcnow()
+    deletion = mongo.db.project_deletions.find_one_and_update(
+        {'status': {'$in': ['pending', 'running', 'failed']},
+         '$or': [{'lease_expires': {'$lte': now}}, {'lease_expires': {'$exists': False}}]},
+        {'$set': {'owner': _owner(), 'lease_expires': _lease()}},
+        projection={'_id': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return deletion['_id'] if deletion else None
+
+def resume_pending_deletions():
+    """
+    Restart cleanup of projects whose deleting process stopped renewing its lease, or failed.
+    Deletions that another live process is purging are left alone.
+    Runs at most once every RESUME_INTERVAL_SECONDS per process.
+    """
+    global _last_resume
+    with _resume_lock:
+        if _last_resume and time.monotonic() - _last_resume < RESUME_INTERVAL_SECONDS:
+            return
+        _last_resume = time.monotonic()
+    while True:
+        project_id = _claim_expired()
+        if project_id is None:
+            break
+        _submit(project_id)
+
+def _run_resumer():
+    while True:
+        try:
+            resume_pending_deletions()
+        except Exception as e:
+            print(f"Resuming project deletions failed: {e}")
+        # A little past the interval, so the throttle in resume_pending_deletions never skips a pass
+        time.sleep(RESUME_INTERVAL_SECONDS + 1)
+
+def start_resumer():
+    """
+    Start the background thread of this process that resumes abandoned deletions every
+    RESUME_INTERVAL_SECONDS, if it is not running yet. Each serving process starts its own
+    (see init_database and gunicorn.conf.py), so a deletion interrupted by a recycled or
+    killed worker is picked up again without waiting for the next project deletion.
+    """
+    global _resumer
+    with _resume_lock:
+        if _resumer is None or not _resumer.is_alive():
+            _resumer = threading.Thread(target=_run_resumer, name='deletion-resumer', daemon=True)
+            _resumer.start()
+
+def request_project_deletion(project_id):
+    """
+    Tombstone a project and queue the cleanup of its versions.
+    Returns False if the project does not exist or is already being deleted.
+    """
+    resume_pending_deletions()
+    project_id = ObjectId(project_id)
+    now = datetime.utcnow()
+    result = mongo.db.projects.update_one(
+        {'_id': project_id, 'deleted_at': {'$exists': False}},
+        {'$set': {'deleted_at': now}}
+    )
+    if not result.modified_count:
+        return False
+    # Hits for a project being deleted would point at versions about to disappear
+    search.remove_project(project_id)
+
+    mongo.db.project_deletions.replace_one({'_id': project_id}, {
+        '_id': project_id,
+        'status': 'pending',
+        'total': file_storage.count_project_versions(project_id),
+        'deleted': 0,
+        'started_at': now,
+        'owner': _owner(),
+        'lease_expires': _lease()
+    }, upsert=True)
+    _submit(project_id)
+    return True
+
+def get_deletion_status(project_id):
+    if not ObjectId.is_valid(project_id):
+        return None
+    return mongo.db.project_deletions.find_one({'_id': ObjectId(project_id)})
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from werkzeug.utils import secure_filename
+
+# Local files (tempdir uploads, documents opened for conversion) live in one scratch
+# directory per session. A background janitor removes directories unused for
+# SCRATCH_MAX_AGE_SECONDS and, oldest first, whatever exceeds SCRATCH_MAX_BYTES in total.
+SCRATCH_ROOT = os.path.join(tempfile.gettempdir(), 'attackflow-scratch')
+# Per-host copies of stored PDFs, shared by every session (see conversion.local_source)
+SHARED_SOURCE_DIR = os.path.join(tempfile.gettempdir(), 'attackflow-pages')
+SESSION_QUOTA_BYTES = 200 * 1024 * 1024
+SCRATCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+SCRATCH_MAX_AGE_SECONDS = 6 * 60 * 60
+JANITOR_INTERVAL_SECONDS = 60
+COPY_BLOCK_SIZE = 1024 * 1024
+
+SWEPT_ROOTS = (SCRATCH_ROOT, SHARED_SOURCE_DIR)
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+def _usage(path):
+    """
+    Return (bytes, last modification time) of a file or directory tree.
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    total, newest = 0, os.stat(path).st_mtime
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return total, newest
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def session_dir(sid):
+    path = os.path.join(SCRATCH_ROOT, secure_filename(sid))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write_scratch_file(sid, filename, stream):
+    """
+    Copy a stream into the session's scratch directory and return the local path.
+    Raises ScratchQuotaExceeded, leaving nothing behind, if the session would go over
+    SESSION_QUOTA_BYTES.
+    """
+    start_janitor()
+    directory = session_dir(sid)
+    path = os.path.join(directory, secure_filename(os.path.basename(filename)) or 'upload')
+    if os.path.exists(path):
+        os.remove(path)
+    budget = SESSION_QUOTA_BYTES - _usage(directory)[0]
+
+    with open(path, 'wb') as f:
+        for block in iter(lambda: stream.read(COPY_BLOCK_SIZE), b''):
+            budget -= len(block)
+            if budget < 0:
+                break
+            f.write(block)
+    if budget < 0:
+        os.remove(path)
+        raise ScratchQuotaExceeded(f"Scratch space for this session is limited to {SESSION_QUOTA_BYTES // (1024 * 1024)} MB")
+    return path
+
+def remove_session_dir(sid):
+    _remove(os.path.join(SCRATCH_ROOT, secure_filename(sid)))
+
+def sweep():
+    """
+    Remove scratch entries older than SCRATCH_MAX_AGE_SECONDS, then the least recently
+    used ones until the total is under SCRATCH_MAX_BYTES. Returns the number of bytes freed.
+    """
+    entries = []
+    for root in SWEPT_ROOTS:
+        if not os.path.isdir(root):
+            continue
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                size, last_used = _usage(path)
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, path))
+
+    entries.sort()
+    cutoff = time.time() - SCRATCH_MAX_AGE_SECONDS
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for last_used, size, path in entries:
+        if last_used >= cutoff and total - freed <= SCRATCH_MAX_BYTES:
+            break
+        _remove(path)
+        freed += size
+    return freed
+
+def _run_janitor():
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            print(f"Scratch janitor failed: {e}")
+        time.sleep(JANITOR_INTERVAL_SECONDS)
+
+def start_janitor():
+    """
+    Start the background janitor of this process, if it is not running yet.
+    """
+    global _janitor
+    with _janitor_lock:
+        if _janitor is None or not _janitor.is_alive():
+            _janitor = threading.Thread(target=_run_janitor, name='scratch-janitor', daemon=True)
+            _janitor.start()
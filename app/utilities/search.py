@@ -0,0 +1,156 @@
+import re
+from html.parser import HTMLParser
+from datetime import datetime
+from bson import ObjectId
+from pymongo import DESCENDING
+from .. import mongo
+from . import annotations as annotation_store
+
+# Full-text search over saved versions. Every version written by update_version gets one
+# document in SEARCH_COLLECTION holding the visible text of its HTML and the text of its
+# annotations, covered by a single weighted MongoDB text index (see indexes.py).
+# Queries use MongoDB's text search syntax: "quoted phrases" and -excluded words.
+# Single annotation edits only count themselves in annotation_edits; the annotation text of
+# edited versions is rebuilt in one batch before the next search.
+SEARCH_COLLECTION = 'search_index'
+SEARCH_INDEX_NAME = 'search_text'
+SEARCH_WEIGHTS = {'project_name': 10, 'annotation_text': 5, 'text': 1}
+# Keeps index entries well under the 16 MB document limit for very long reports
+MAX_INDEXED_CHARS = 2 * 1024 * 1024
+MAX_PAGE_SIZE = 50
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collect the visible text of an HTML document, leaving out scripts and styles.
+    """
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+def extract_text(html):
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return _WHITESPACE.sub(' ', ' '.join(parser.parts)).strip()[:MAX_INDEXED_CHARS]
+
+def _annotation_text(annotations):
+    fields = ('selected_text', 'tag', 'code')
+    return ' '.join(str(annotation[field]) for annotation in annotations or []
+                    for field in fields if annotation.get(field))[:MAX_INDEXED_CHARS]
+
+def _collection():
+    return mongo.db[SEARCH_COLLECTION]
+
+def index_version(project_id, file_id, filename, html, annotations, version_date=None):
+    """
+    Add or replace the search entry of one version.
+    """
+    project = mongo.db.projects.find_one({'_id': ObjectId(project_id)}, {'project_name': 1})
+    _collection().replace_one({'_id': ObjectId(file_id)}, {
+        '_id': ObjectId(file_id),
+        'project_id': ObjectId(project_id),
+        'project_name': project['project_name'] if project else '',
+        'filename': filename,
+        'version_date': version_date or datetime.utcnow(),
+        'text': extract_text(html),
+        'annotation_text': _annotation_text(annotations)
+    }, upsert=True)
+
+def annotations_changed(document_id):
+    """
+    Record that one annotation of a version was edited. Nothing is read, and versions that
+    are not indexed (such as stored PDFs) are not touched at all.
+    """
+    _collection().update_one({'_id': ObjectId(document_id)}, {'$inc': {'annotation_edits': 1}})
+
+def refresh_annotations():
+    """
+    Rebuild the annotation text of every version edited since the last refresh, once per
+    version however many edits it received. Returns the number of versions refreshed.
+    """
+    refreshed = 0
+    for entry in _collection().find({'annotation_edits': {'$exists': True}}, {'annotation_edits': 1}):
+        text = _annotation_text(annotation_store.get_annotations(entry['_id']))
+        # Edits made while the text was rebuilt leave the counter set for the next refresh
+        result = _collection().update_one(
+            {'_id': entry['_id'], 'annotation_edits': entry['annotation_edits']},
+            {'$set': {'annotation_text': text}, '$unset': {'annotation_edits': ''}}
+        )
+        refreshed += result.modified_count
+    return refreshed
+
+def remove_versions(file_ids):
+    _collection().delete_many({'_id': {'$in': [ObjectId(file_id) for file_id in file_ids]}})
+
+def remove_project(project_id):
+    _collection().delete_many({'project_id': ObjectId(project_id)})
+
+def search(query, page=1, per_page=20):
+    """
+    Return one page of versions matching a text query, best matches first.
+
+    :param query: The search terms.
+    :param page: The 1-based page number.
+    :param per_page: The number of hits per page, at most MAX_PAGE_SIZE.
+    :return: The hits and whether a further page exists.
+    """
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    refresh_annotations()
+    score = {'$meta': 'textScore'}
+    # One extra hit tells whether there is a next page without counting every match
+    cursor = _collection().find(
+        {'$text': {'$search': query}},
+        {'score': score, 'project_id': 1, 'project_name': 1, 'filename': 1, 'version_date': 1}
+    ).sort([('score', score), ('version_date', DESCENDING)]).skip((page - 1) * per_page).limit(per_page + 1)
+
+    hits = [{
+        'file_id': str(doc['_id']),
+        'project_id': str(doc['project_id']),
+        'project_name': doc['project_name'],
+        'filename': doc['filename'],
+        'version_date': doc['version_date'],
+        'score': round(doc['score'], 3)
+    } for doc in cursor]
+    return hits[:per_page], len(hits) > per_page
+
+def reindex_all():
+    """
+    Build the search entries of every HTML version saved before search existed.
+    Returns the number of versions indexed.
+    """
+    from .version_store import read_version
+
+    indexed = 0
+    for version in mongo.db.project_versions.find({}, {'project_id': 1, 'file_id': 1, 'version_date': 1}):
+        file_doc = mongo.db.fs.files.find_one({'_id': version['file_id']}, {'filename': 1})
+        if not file_doc or not file_doc['filename'].endswith('.html'):
+            continue
+        if _collection().find_one({'_id': version['file_id']}, {'_id': 1}):
+            continue
+        content = read_version(version['file_id'])
+        if content is None:
+            continue
+        index_version(version['project_id'], version['file_id'], file_doc['filename'], content,
+                      annotation_store.get_annotations(version['file_id']), version['version_date'])
+        indexed += 1
+    return indexed
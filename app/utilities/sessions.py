@@ -0,0 +1,125 @@
+import secrets
+import threading
+from datetime import datetime
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from .. import mongo
+
+# Sessions are kept on the server and the cookie only carries a random session id,
+# so every worker and replica sees the same flow state (uploads, open file, project).
+SESSION_COLLECTION = 'sessions'
+SESSION_ID_BYTES = 32
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class MongoSessionStore:
+    """
+    Session data in a MongoDB collection, shared by every worker. A TTL index on
+    expires_at (see indexes.py) removes abandoned sessions.
+    """
+    def load(self, sid):
+        doc = mongo.db[SESSION_COLLECTION].find_one({'_id': sid, 'expires_at': {'$gt': datetime.utcnow()}})
+        return doc['data'] if doc else None
+
+    def save(self, sid, data, expires_at):
+        mongo.db[SESSION_COLLECTION].replace_one(
+            {'_id': sid},
+            {'_id': sid, 'data': data, 'expires_at': expires_at},
+            upsert=True
+        )
+
+    def delete(self, sid):
+        mongo.db[SESSION_COLLECTION].delete_one({'_id': sid})
+
+
+class LocalSessionStore:
+    """
+    In-memory stand-in for MongoSessionStore. Only valid with a single worker process,
+    e.g. the Flask debug server.
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at <= datetime.utcnow():
+                del self._sessions[sid]
+                return None
+            return dict(data)
+
+    def save(self, sid, data, expires_at):
+        with self._lock:
+            self._sessions[sid] = (dict(data), expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+SESSION_STORES = {
+    'mongo': MongoSessionStore,
+    'local': LocalSessionStore,
+}
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps the session in a store and only the id in the cookie.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(SESSION_ID_BYTES), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Only write when the flow state changed; read-only requests cost a single lookup
+        if session.modified:
+            self.store.save(session.sid, dict(session), datetime.utcnow() + app.permanent_session_lifetime)
+        if session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
+
+def create_session_interface(backend):
+    """
+    Return a ServerSessionInterface for the named store ('mongo' or 'local').
+    """
+    if backend not in SESSION_STORES:
+        raise ValueError(f"Unknown session backend: {backend}")
+    return ServerSessionInterface(SESSION_STORES[backend]())
@@ -0,0 +1,294 @@
+import hashlib
+from gridfs import DEFAULT_CHUNK_SIZE
+from gridfs.errors import NoFile
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+from .. import mongo, config
+from datetime import datetime, timedelta
+from . import file_storage
+from .storage_backends import GridFSBackend
+
+# Uploads wait in their own GridFS bucket until /save or /create_project promotes them
+STAGING_BUCKET = 'staging'
+STAGING_TTL_SECONDS = 6 * 60 * 60
+
+# Resumable uploads arrive in appends of at most MAX_APPEND_BYTES at the offset the server
+# has reached. Their chunks go straight into the staging bucket, while their progress is
+# kept in the staging_uploads collection; finalizing adds the staging.files document.
+MAX_APPEND_BYTES = 16 * 1024 * 1024
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024
+
+_store = GridFSBackend(STAGING_BUCKET)
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+class ChecksumMismatch(Exception):
+    pass
+
+def _bucket():
+    return _store.bucket()
+
+class _HashingReader:
+    """
+    Wrap a stream and compute the SHA-256 of everything read from it.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        return data
+
+def stage_upload(stream, filename):
+    """
+    Stream an upload straight into the staging bucket, recording its SHA-256 on the way
+    so promote_staged_file can deduplicate it without reading it again.
+    Returns the ObjectId of the staged file.
+    """
+    purge_expired_staged_files()
+    reader = _HashingReader(stream)
+    staged_id = _bucket().upload_from_stream(filename, reader)
+    mongo.db[f'{STAGING_BUCKET}.files'].update_one({'_id': staged_id}, {'$set': {'metadata.sha256': reader.digest.hexdigest()}})
+    return staged_id
+
+def get_staged_file(staged_id):
+    """
+    Return the staged file as a GridOut, or None if it does not exist (or has expired).
+    """
+    if not ObjectId.is_valid(staged_id):
+        return None
+    try:
+        return _bucket().open_download_stream(ObjectId(staged_id))
+    except NoFile:
+        return None
+
+def download_staged_file(staged_id, path):
+    """
+    Write a staged file to a local path, for tools such as pdftohtml that need one.
+    Returns False if the staged file does not exist.
+    """
+    staged = get_staged_file(staged_id)
+    if staged is None:
+        return False
+    with open(path, 'wb') as f:
+        for chunk in staged:
+            f.write(chunk)
+    return True
+
+def _acquire_staged_blob(staged_doc):
+    """
+    Take a reference to the blob holding the staged content, deduplicated by its SHA-256.
+    New content becomes a blob by copying the staged chunks inside MongoDB, so the bytes
+    never pass through the app. Returns the blob's ObjectId.
+    """
+    sha256 = staged_doc['metadata']['sha256']
+    blob_bucket = file_storage.BLOB_BUCKET
+    for _ in range(file_storage.MAX_STORE_ATTEMPTS):
+        blob = file_storage.acquire_stored_blob(sha256)
+        if blob:
+            return blob[0]
+
+        mongo.db[f'{STAGING_BUCKET}.chunks'].aggregate([
+            {'$match': {'files_id': staged_doc['_id']}},
+            {'$merge': {'into': f'{blob_bucket}.chunks', 'whenMatched': 'fail'}}
+        ])
+        try:
+            mongo.db[f'{blob_bucket}.files'].insert_one({
+                '_id': staged_doc['_id'],
+                'filename': sha256,
+                'length': staged_doc['length'],
+                'chunkSize': staged_doc['chunkSize'],
+                'uploadDate': datetime.utcnow(),
+                'metadata': {'sha256': sha256, 'refcount': 1, 'backend': 'gridfs'}
+            })
+        except DuplicateKeyError:
+            # The same content was stored meanwhile, or is held by a blob left unreferenced
+            mongo.db[f'{blob_bucket}.chunks'].delete_many({'files_id': staged_doc['_id']})
+            blob = file_storage.acquire_stored_blob(sha256, takeover=True)
+            if blob:
+                return blob[0]
+            continue
+        return staged_doc['_id']
+    raise RuntimeError(f"Could not store blob {sha256} after {file_storage.MAX_STORE_ATTEMPTS} attempts")
+
+def promote_staged_file(staged_id, filename, annotations=[], unique_name=False):
+    """
+    Move a staged file into the main GridFS bucket under its final filename.
+    The content is deduplicated through the blob bucket like save_file does, using the
+    SHA-256 recorded when the file was staged. Files staged without one, HTML and JSON
+    (stored compressed) and storage backends other than GridFS go through file_storage.save_file.
+    With unique_name=True DuplicateKeyError is raised if the name is already taken,
+    and the staged file is kept.
+    Returns the ObjectId of the promoted file, which keeps the staged id.
+    """
+    if not ObjectId.is_valid(staged_id):
+        return None
+    staged_id = ObjectId(staged_id)
+
+    staged_doc = mongo.db[f'{STAGING_BUCKET}.files'].find_one({'_id': staged_id})
+    if not staged_doc:
+        print(f"No staged file found with ObjectId: {staged_id}")
+        return None
+
+    sha256 = (staged_doc.get('metadata') or {}).get('sha256')
+    if config.STORAGE_BACKEND != 'gridfs' or not sha256 or file_storage.should_compress(filename):
+        file_id = file_storage.save_file(_bucket().open_download_stream(staged_id), filename, annotations, unique_name)
+        discard_staged_file(staged_id)
+        return file_id
+
+    blob_id = _acquire_staged_blob(staged_doc)
+    file_id = file_storage.add_file_entry(filename, blob_id, sha256, staged_doc['length'], annotations,
+                                          unique_name, file_id=staged_id)
+    discard_staged_file(staged_id)
+    return file_id
+
+def discard_staged_file(staged_id):
+    """
+    Remove a staged file and its chunks. Missing files are ignored.
+    """
+    if not ObjectId.is_valid(staged_id):
+        return
+    try:
+        _bucket().delete(ObjectId(staged_id))
+    except NoFile:
+        pass
+
+def purge_expired_staged_files():
+    """
+    Delete staged uploads older than STAGING_TTL_SECONDS, chunks included,
+    and resumable uploads that saw no append for that long.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=STAGING_TTL_SECONDS)
+    expired = [doc['_id'] for doc in mongo.db[f'{STAGING_BUCKET}.files'].find({'uploadDate': {'$lt': cutoff}}, {'_id': 1})]
+    abandoned = [doc['_id'] for doc in mongo.db.staging_uploads.find({'updated_at': {'$lt': cutoff}}, {'_id': 1})]
+    if abandoned:
+        mongo.db.staging_uploads.delete_many({'_id': {'$in': abandoned}})
+        expired += abandoned
+    if expired:
+        mongo.db[f'{STAGING_BUCKET}.chunks'].delete_many({'files_id': {'$in': expired}})
+        mongo.db[f'{STAGING_BUCKET}.files'].delete_many({'_id': {'$in': expired}})
+
+
+# ---------- RESUMABLE UPLOADS ----------
+def start_upload(filename, size):
+    """
+    Open a resumable upload of size bytes. Returns the upload id, which becomes the staged file id.
+    """
+    purge_expired_staged_files()
+    upload_id = ObjectId()
+    now = datetime.utcnow()
+    mongo.db.staging_uploads.insert_one({
+        '_id': upload_id,
+        'filename': filename,
+        'size': size,
+        'offset': 0,
+        'chunk_size': DEFAULT_CHUNK_SIZE,
+        'created_at': now,
+        'updated_at': now
+    })
+    return upload_id
+
+def get_upload(upload_id):
+    if not ObjectId.is_valid(upload_id):
+        return None
+    return mongo.db.staging_uploads.find_one({'_id': ObjectId(upload_id)})
+
+def append_upload(upload_id, offset, data, sha256=None):
+    """
+    Write data at offset, which must be where the upload currently ends.
+    Raises OffsetMismatch (carrying the current offset) so the client can resume from there,
+    and ChecksumMismatch if sha256 is given and does not match the data.
+    Returns the new offset, or None if the upload does not exist.
+    """
+    upload = get_upload(upload_id)
+    if upload is None:
+        return None
+    if offset != upload['offset'] or offset + len(data) > upload['size']:
+        raise OffsetMismatch(upload['offset'])
+    if sha256 and hashlib.sha256(data).hexdigest() != sha256.lower():
+        raise ChecksumMismatch("Chunk checksum does not match")
+
+    # GridFS chunks all have chunk_size bytes except the last; a partial last chunk
+    # is completed with the start of this append
+    chunks = mongo.db[f'{STAGING_BUCKET}.chunks']
+    chunk_size = upload['chunk_size']
+    n, partial = divmod(offset, chunk_size)
+    if partial:
+        previous = chunks.find_one({'files_id': upload['_id'], 'n': n}, {'data': 1})
+        data = bytes(previous['data'])[:partial] + data
+    for start in range(0, len(data), chunk_size):
+        chunks.replace_one(
+            {'files_id': upload['_id'], 'n': n},
+            {'files_id': upload['_id'], 'n': n, 'data': Binary(data[start:start + chunk_size])},
+            upsert=True
+        )
+        n += 1
+
+    new_offset = offset - partial + len(data)
+    result = mongo.db.staging_uploads.update_one(
+        {'_id': upload['_id'], 'offset': offset},
+        {'$set': {'offset': new_offset, 'updated_at': datetime.utcnow()}}
+    )
+    if not result.modified_count:
+        # Another append for the same offset won the race
+        raise OffsetMismatch(get_upload(upload_id)['offset'])
+    return new_offset
+
+def finalize_upload(upload_id, sha256=None):
+    """
+    Check that every byte arrived and, if given, that the content has the expected SHA-256,
+    then turn the upload into a staged file. Returns the staged file id, or None if the
+    upload does not exist. Raises OffsetMismatch if bytes are missing and ChecksumMismatch
+    (after discarding the upload) if the content is corrupt.
+    Finalizing twice, concurrently or as a retry, returns the same staged file id.
+    """
+    upload = get_upload(upload_id)
+    if upload is None:
+        # Already finalized by an earlier or concurrent request
+        return _finalized_id(upload_id)
+    if upload['offset'] != upload['size']:
+        raise OffsetMismatch(upload['offset'])
+
+    digest = hashlib.sha256()
+    for chunk in mongo.db[f'{STAGING_BUCKET}.chunks'].find({'files_id': upload['_id']}).sort('n', 1):
+        digest.update(chunk['data'])
+    if sha256 and digest.hexdigest() != sha256.lower():
+        discard_upload(upload['_id'])
+        raise ChecksumMismatch("File checksum does not match, upload it again")
+
+    try:
+        mongo.db[f'{STAGING_BUCKET}.files'].insert_one({
+            '_id': upload['_id'],
+            'length': upload['size'],
+            'chunkSize': upload['chunk_size'],
+            'uploadDate': datetime.utcnow(),
+            'filename': upload['filename'],
+            'metadata': {'sha256': digest.hexdigest()}
+        })
+    except DuplicateKeyError:
+        # A concurrent finalize staged the same chunks first
+        pass
+    mongo.db.staging_uploads.delete_one({'_id': upload['_id']})
+    return upload['_id']
+
+def _finalized_id(upload_id):
+    if not ObjectId.is_valid(upload_id):
+        return None
+    staged = mongo.db[f'{STAGING_BUCKET}.files'].find_one({'_id': ObjectId(upload_id)}, {'_id': 1})
+    return staged['_id'] if staged else None
+
+def discard_upload(upload_id):
+    """
+    Abort a resumable upload and drop the chunks received so far.
+    """
+    if not ObjectId.is_valid(upload_id):
+        return
+    upload_id = ObjectId(upload_id)
+    mongo.db.staging_uploads.delete_one({'_id': upload_id})
+    mongo.db[f'{STAGING_BUCKET}.chunks'].delete_many({'files_id': upload_id})
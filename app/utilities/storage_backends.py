@@ -0,0 +1,128 @@
+import io
+import os
+from datetime import datetime
+from gridfs import GridFSBucket, GridOut, DEFAULT_CHUNK_SIZE
+from gridfs.errors import FileExists
+from pymongo.errors import DuplicateKeyError
+from .. import mongo
+
+# Where blob bytes live. Blob metadata (hash, refcount, encoding) always stays in the
+# <bucket>.files collection; metadata.backend records which backend holds the bytes,
+# so blobs written before a backend switch stay readable.
+DEFAULT_BACKEND = 'gridfs'
+LOCAL_WRITE_BLOCK_SIZE = 1024 * 1024
+
+
+class LocalBlob(io.FileIO):
+    """
+    A blob stored on the local filesystem, opened for reading.
+    Quacks like a GridOut (metadata, length, chunk_size) and exposes its path for sendfile.
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def __init__(self, path, blob_doc):
+        super().__init__(path, 'rb')
+        self.path = path
+        self.metadata = blob_doc.get('metadata') or {}
+        self.length = blob_doc['length']
+
+
+class GridFSBackend:
+    """
+    Blob bytes in the chunks of a GridFS bucket, through one GridFSBucket per database.
+    """
+    name = 'gridfs'
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self._db = None
+        self._bucket = None
+
+    def bucket(self):
+        if self._db is not mongo.db:
+            self._db, self._bucket = mongo.db, GridFSBucket(mongo.db, bucket_name=self.bucket_name)
+        return self._bucket
+
+    def put(self, blob_id, sha256, data, metadata):
+        """
+        Store the bytes and create the blob document. Returns the stored length.
+        Raises DuplicateKeyError, leaving nothing behind, if the hash is already stored.
+        """
+        try:
+            self.bucket().upload_from_stream_with_id(blob_id, sha256, data, metadata=metadata)
+        except (DuplicateKeyError, FileExists) as e:
+            # GridFS reports the unique index rejecting the files document as FileExists,
+            # after the chunks were written
+            mongo.db[f'{self.bucket_name}.chunks'].delete_many({'files_id': blob_id})
+            if isinstance(e, FileExists):
+                raise DuplicateKeyError(str(e)) from e
+            raise
+        return mongo.db[f'{self.bucket_name}.files'].find_one({'_id': blob_id}, {'length': 1})['length']
+
+    def open(self, blob_doc):
+        return GridOut(mongo.db[self.bucket_name], file_document=blob_doc)
+
+    def delete(self, blob_doc):
+        mongo.db[f'{self.bucket_name}.chunks'].delete_many({'files_id': blob_doc['_id']})
+
+
+class LocalFSBackend:
+    """
+    Blob bytes in files under root, named after their hash and blob id, so large files
+    never travel over the MongoDB wire protocol and can be sent with sendfile.
+    Every blob document owns its own file, which keeps concurrent store and delete safe.
+    """
+    name = 'local'
+
+    def __init__(self, bucket_name, root):
+        self.bucket_name = bucket_name
+        self.root = root
+
+    def path(self, sha256, blob_id):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], f'{sha256}-{blob_id}')
+
+    def put(self, blob_id, sha256, data, metadata):
+        path = self.path(sha256, blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.part'
+        with open(partial, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                for block in iter(lambda: data.read(LOCAL_WRITE_BLOCK_SIZE), b''):
+                    f.write(block)
+        os.replace(partial, path)
+        length = os.path.getsize(path)
+
+        try:
+            mongo.db[f'{self.bucket_name}.files'].insert_one({
+                '_id': blob_id,
+                'filename': sha256,
+                'length': length,
+                'chunkSize': DEFAULT_CHUNK_SIZE,
+                'uploadDate': datetime.utcnow(),
+                'metadata': metadata
+            })
+        except DuplicateKeyError:
+            os.remove(path)
+            raise
+        return length
+
+    def open(self, blob_doc):
+        return LocalBlob(self.path(blob_doc['filename'], blob_doc['_id']), blob_doc)
+
+    def delete(self, blob_doc):
+        try:
+            os.remove(self.path(blob_doc['filename'], blob_doc['_id']))
+        except FileNotFoundError:
+            pass
+
+
+def create_backends(bucket_name, local_root):
+    """
+    Return every backend for a bucket, keyed by the name stored in metadata.backend.
+    """
+    return {
+        'gridfs': GridFSBackend(bucket_name),
+        'local': LocalFSBackend(bucket_name, local_root),
+    }
@@ -0,0 +1,275 @@
+import re
+import json
+import hashlib
+import bisect
+import difflib
+import threading
+from collections import OrderedDict
+from gridfs import GridOut, DEFAULT_CHUNK_SIZE
+from bson import ObjectId
+from .. import mongo
+from datetime import datetime
+from .file_storage import acquire_blob, release_blob, read_blob, referenced_assets, acquire_assets
+from . import annotations as annotation_store
+
+# Every KEYFRAME_INTERVAL-th HTML version is stored in full, the ones in between as deltas
+# against the previous version. Reconstructed versions are kept in a small LRU cache.
+KEYFRAME_INTERVAL = 10
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Split HTML after every closing '>' so deltas work on markup-sized pieces
+# even when the browser serialises the whole document on a single line.
+_TOKEN_PATTERN = re.compile(r'(?<=>)')
+# pdftohtml markup repeats tokens such as <br/> thousands of times, which makes an
+# exhaustive diff quadratic; only gaps without unique anchors up to this size get one
+SMALL_GAP_TOKENS = 2000
+# Anchor searches stop once they have scanned this many times the tokens of both versions;
+# whatever is left unmatched is stored literally, and save_version may then prefer a keyframe
+DIFF_WORK_FACTOR = 20
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+# ---------- CACHE ----------
+def _cache_get(file_id):
+    with _cache_lock:
+        content = _cache.get(file_id)
+        if content is not None:
+            _cache.move_to_end(file_id)
+        return content
+
+def _cache_put(file_id, content):
+    global _cache_bytes
+    if len(content) > CACHE_MAX_BYTES:
+        return
+    with _cache_lock:
+        if file_id in _cache:
+            return
+        _cache[file_id] = content
+        _cache_bytes += len(content)
+        while _cache_bytes > CACHE_MAX_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+
+# ---------- DELTAS ----------
+def _tokenize(text):
+    return _TOKEN_PATTERN.split(text)
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    """
+    Return (i, j) pairs of tokens occurring exactly once in a[alo:ahi] and in b[blo:bhi],
+    keeping the longest run that is increasing on both sides (the patience diff anchors).
+    """
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.setdefault(a[i], [0, i, 0, 0])
+        entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted((entry[1], entry[3]) for entry in counts.values() if entry[0] == 1 and entry[2] == 1)
+
+    # Longest increasing subsequence of the b positions, in O(n log n)
+    tails, tail_indexes, previous = [], [], [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        position = bisect.bisect_left(tails, j)
+        if position:
+            previous[index] = tail_indexes[position - 1]
+        if position == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[position] = j
+            tail_indexes[position] = index
+    anchors = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    return anchors[::-1]
+
+def _matching_blocks(a, b):
+    """
+    Return (i, j, size) blocks of equal tokens in increasing order, in roughly linear time:
+    common prefixes and suffixes are matched first, then unique tokens anchor the rest.
+    Only gaps smaller than SMALL_GAP_TOKENS are compared exhaustively, and the anchor
+    search gives up after DIFF_WORK_FACTOR passes over both versions.
+    """
+    blocks = []
+    budget = DIFF_WORK_FACTOR * (len(a) + len(b))
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        start = 0
+        while alo + start < ahi and blo + start < bhi and a[alo + start] == b[blo + start]:
+            start += 1
+        if start:
+            blocks.append((alo, blo, start))
+            alo, blo = alo + start, blo + start
+        end = 0
+        while alo < ahi - end and blo < bhi - end and a[ahi - end - 1] == b[bhi - end - 1]:
+            end += 1
+        if end:
+            blocks.append((ahi - end, bhi - end, end))
+            ahi, bhi = ahi - end, bhi - end
+        if alo == ahi or blo == bhi:
+            continue
+
+        budget -= (ahi - alo) + (bhi - blo)
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi) if budget > 0 else []
+        if anchors:
+            # Each gap between anchors is diffed on its own; the anchors match in the prefix step
+            bounds = [(alo, blo)] + anchors + [(ahi, bhi)]
+            for (i1, j1), (i2, j2) in zip(bounds, bounds[1:]):
+                stack.append((i1, i2, j1, j2))
+        elif (ahi - alo) + (bhi - blo) <= SMALL_GAP_TOKENS:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            blocks.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+    return sorted(blocks)
+
+def compute_delta(base_text, new_text):
+    """
+    Return the operations that rebuild new_text from base_text:
+    ["c", start, end] copies base tokens, ["i", text] inserts literal text.
+    """
+    base_tokens = _tokenize(base_text)
+    new_tokens = _tokenize(new_text)
+    ops = []
+    j = 0
+    for i1, j1, size in _matching_blocks(base_tokens, new_tokens):
+        if j1 > j:
+            ops.append(['i', ''.join(new_tokens[j:j1])])
+        if ops and ops[-1][0] == 'c' and ops[-1][2] == i1 and j1 == j:
+            ops[-1][2] = i1 + size
+        else:
+            ops.append(['c', i1, i1 + size])
+        j = j1 + size
+    if j < len(new_tokens):
+        ops.append(['i', ''.join(new_tokens[j:])])
+    return ops
+
+def apply_delta(base_text, ops):
+    base_tokens = _tokenize(base_text)
+    parts = []
+    for op in ops:
+        if op[0] == 'c':
+            parts.extend(base_tokens[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return ''.join(parts)
+
+
+# ---------- READING ----------
+def _read_full(file_doc):
+    metadata = file_doc.get('metadata') or {}
+    if metadata.get('blob_id'):
+        return read_blob(metadata['blob_id'])
+    return GridOut(mongo.db.fs, file_document=file_doc).read()
+
+def is_delta(file_doc):
+    return bool((file_doc.get('metadata') or {}).get('delta_base'))
+
+def read_version(file_id):
+    """
+    Return the full bytes of a stored version, following its delta chain back to the keyframe.
+    """
+    file_id = ObjectId(file_id)
+    cached = _cache_get(file_id)
+    if cached is not None:
+        return cached
+
+    # Walk back until a keyframe or a cached ancestor
+    chain = []
+    file_doc = mongo.db.fs.files.find_one({'_id': file_id})
+    content = None
+    while file_doc is not None and is_delta(file_doc):
+        chain.append(file_doc)
+        content = _cache_get(file_doc['metadata']['delta_base'])
+        if content is not None:
+            break
+        file_doc = mongo.db.fs.files.find_one({'_id': file_doc['metadata']['delta_base']})
+    if content is None:
+        if file_doc is None:
+            print(f"Broken version chain for file with ObjectId: {file_id}")
+            return None
+        content = _read_full(file_doc)
+        if content is None:
+            return None
+
+    text = content.decode('utf-8')
+    for delta_doc in reversed(chain):
+        delta = read_blob(delta_doc['metadata']['blob_id'])
+        if delta is None:
+            print(f"Missing delta for file with ObjectId: {delta_doc['_id']}")
+            return None
+        text = apply_delta(text, json.loads(delta))
+    content = text.encode('utf-8')
+
+    _cache_put(file_id, content)
+    return content
+
+
+# ---------- WRITING ----------
+def save_version(html, filename, annotations, base_file_id=None):
+    """
+    Store a new HTML version as a delta against base_file_id, or as a keyframe when there is
+    no usable base, the chain is due for a keyframe, or the delta would not save space.
+    Returns the ObjectId of the new fs.files entry.
+    """
+    content = html.encode('utf-8') if isinstance(html, str) else html
+    metadata = {'content_length': len(content), 'content_sha256': hashlib.sha256(content).hexdigest()}
+
+    base_doc = mongo.db.fs.files.find_one({'_id': ObjectId(base_file_id)}) if base_file_id else None
+    delta = None
+    if base_doc is not None and base_doc['filename'].endswith('.html'):
+        chain_length = (base_doc.get('metadata') or {}).get('chain_length', 0) + 1
+        base_content = read_version(base_doc['_id'])
+        if chain_length < KEYFRAME_INTERVAL and base_content is not None:
+            ops = compute_delta(base_content.decode('utf-8'), content.decode('utf-8'))
+            encoded = json.dumps(ops, separators=(',', ':')).encode('utf-8')
+            if len(encoded) < len(content) // 2:
+                delta = encoded
+                metadata.update({'delta_base': base_doc['_id'], 'chain_length': chain_length})
+
+    blob_id, sha256, _ = acquire_blob(delta if delta is not None else content, compress=True)
+    metadata.update({'blob_id': blob_id, 'sha256': sha256})
+    # Extracted images stay stored for as long as a version using them exists
+    asset_ids = referenced_assets(content)
+    if asset_ids:
+        metadata['asset_ids'] = asset_ids
+        acquire_assets(asset_ids)
+
+    result = mongo.db.fs.files.insert_one({
+        'filename': filename,
+        'length': 0,
+        'chunkSize': DEFAULT_CHUNK_SIZE,
+        'uploadDate': datetime.utcnow(),
+        'metadata': metadata
+    })
+    annotation_store.set_annotations(result.inserted_id, annotations)
+    _cache_put(result.inserted_id, content)
+    return result.inserted_id
+
+def detach_dependents(file_ids):
+    """
+    Turn every version stored as a delta against one of file_ids into a keyframe,
+    so those files can be deleted without breaking their chains.
+    Versions that are themselves in file_ids are left alone.
+    """
+    file_ids = [ObjectId(file_id) for file_id in file_ids]
+    for dependent in mongo.db.fs.files.find({'metadata.delta_base': {'$in': file_ids}, '_id': {'$nin': file_ids}}):
+        content = read_version(dependent['_id'])
+        if content is None:
+            continue
+        blob_id, sha256, _ = acquire_blob(content, compress=True)
+        mongo.db.fs.files.update_one(
+            {'_id': dependent['_id']},
+            {'$set': {'metadata.blob_id': blob_id, 'metadata.sha256': sha256, 'metadata.chain_length': 0},
+             '$unset': {'metadata.delta_base': ''}}
+        )
+        release_blob(dependent['metadata']['blob_id'])
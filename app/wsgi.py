@@ -0,0 +1,7 @@
+import sys
+sys.path.append('..')
+
+from app import app
+from app import routes, commands  # registers the routes
+
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
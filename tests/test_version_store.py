@@ -0,0 +1,59 @@
+import json
+import random
+from app.utilities.version_store import compute_delta, apply_delta
+
+# Long reports full of pdftohtml's repeated <br/>, <b> and <i> tokens must still give small
+# deltas that rebuild the new version exactly.
+WORDS = ['alpha', 'beta', 'gamma', 'APT29', 'Cobalt', 'Strike', 'the', 'of', 'and', 'CVE-2021-44228']
+
+
+def pdftohtml_report(pages, seed=0):
+    rng = random.Random(seed)
+    out = []
+    for page in range(pages):
+        out.append(f'<div id="page{page}-div" style="position:relative;"><p style="top:{page}px">')
+        for line in range(40):
+            out.append(' '.join(rng.choice(WORDS) for _ in range(8)) + '<br/>')
+            if line % 5 == 0:
+                out.append('<b>bold</b><i>italic</i>')
+        out.append('</p></div>')
+    return ''.join(out)
+
+
+def annotate(html, count, seed=1):
+    # Highlights wrapped around text at random places, as the annotator does
+    rng = random.Random(seed)
+    for annotation_id in range(count):
+        position = html.find('<br/>', rng.randrange(len(html)))
+        if position < 0:
+            position = len(html)
+        html = (html[:position] + f'<span class="highlighted-text" data-annotation-id="{annotation_id}">x</span>'
+                + html[position:])
+    return html
+
+
+def test_large_report_delta_is_small():
+    base = pdftohtml_report(300)
+    assert len(base) > 600 * 1024
+    new = annotate(base, 100)
+
+    ops = compute_delta(base, new)
+    assert apply_delta(base, ops) == new
+    assert len(json.dumps(ops)) < len(new) // 20
+
+
+def test_repeated_tokens_without_anchors_give_small_delta():
+    base = '<br/>' * 200000
+    new = '<br/>' * 120000 + '<i>' + '<br/>' * 80000
+
+    ops = compute_delta(base, new)
+    assert apply_delta(base, ops) == new
+    assert len(json.dumps(ops)) < len(new) // 20
+
+
+def test_unrelated_versions_round_trip():
+    base = pdftohtml_report(50, seed=2)
+    new = pdftohtml_report(50, seed=3)
+
+    ops = compute_delta(base, new)
+    assert apply_delta(base, ops) == new